@@ -0,0 +1,302 @@
+#! /usr/bin/python
+#-*- encoding=utf8 -*-
+"""
+Generate source and target schemas that differ by a given drift, compare them with dbff in each mode and report
+the speed, peak memory and phase timings of every run. Without --host the schemas live in fakemysql, an in-process
+stand-in for MySQLdb, so the numbers measure dbff itself rather than a server.
+
+e.g.
+python bench/bench.py --rows 50000 --lobs 2 --save /tmp/before.json
+python bench/bench.py --rows 50000 --lobs 2 --baseline /tmp/before.json
+"""
+import argparse
+import json
+import os
+import random
+import re
+import resource
+import string
+import subprocess
+import sys
+import tempfile
+import time
+import traceback
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(HERE))
+sys.path.insert(0, HERE)
+
+SOURCE = 'dbff_bench_source'
+TARGET = 'dbff_bench_target'
+
+
+class Generator(object):
+    def __init__(self, options):
+        """
+        Build the tables of both sides from options, the same ones for the same options and seed.
+        """
+        self.options = options
+        (self.inserts, self.updates, self.deletes) = [int(share) for share in options.mix.split(',')]
+        # rows the tables generated so far differ by, the changes every mode has to find
+        self.planted = 0
+        # values are slices of these, much faster to make than a random string each
+        rnd = random.Random(options.seed)
+        size = max(options.lob_size * 4, 256)
+        self.letters = ''.join([rnd.choice(string.ascii_letters) for i in xrange(256)])
+        self.text = ''.join([rnd.choice(string.printable) for i in xrange(size)])
+        self.bytes = ''.join([chr(rnd.getrandbits(8)) for i in xrange(size)])
+
+    def columns(self):
+        if self.options.composite:
+            key = [('a', 'int(11)', 'NO'), ('b', 'varchar(16)', 'NO')]
+        else:
+            key = [('id', 'int(11)', 'NO')]
+        columns = list(key)
+        for i in xrange(self.options.width):
+            columns.append(('c%d' % i, 'int(11)' if i % 2 == 0 else 'varchar(64)', 'YES'))
+        for i in xrange(self.options.lobs):
+            columns.append(('l%d' % i, 'text' if i % 2 == 0 else 'blob', 'YES'))
+        return columns, [('PRIMARY', 0, [column[0] for column in key])]
+
+    def value(self, rnd, kind):
+        if kind.startswith('int'):
+            return rnd.randint(-2 ** 31, 2 ** 31 - 1)
+        pool = self.letters if kind.startswith('varchar') else self.text if kind == 'text' else self.bytes
+        length = rnd.randint(0, 32 if pool is self.letters else self.options.lob_size * 2)
+        start = rnd.randint(0, len(pool) - length)
+        return pool[start:start + length]
+
+    def key(self, i):
+        return (i / 100, 'k%05d' % (i % 100)) if self.options.composite else (i,)
+
+    def row(self, rnd, i, columns):
+        key = self.key(i)
+        return key + tuple([self.value(rnd, column[1]) for column in columns[len(key):]])
+
+    def tables(self):
+        """
+        @return list  (name, source columns, target columns, indexes, source rows, target rows) of each table
+        """
+        (columns, indexes) = self.columns()
+        tables = []
+        for t in xrange(self.options.tables):
+            rnd = random.Random('%s-%d' % (self.options.seed, t))
+            source = [self.row(rnd, i, columns) for i in xrange(self.options.rows)]
+            target = list(source)
+            drift = int(self.options.rows * self.options.drift / 100)
+            total = (self.inserts + self.updates + self.deletes) or 1
+            picked = rnd.sample(xrange(self.options.rows), min(drift, self.options.rows))
+            inserts = picked[:drift * self.inserts / total]
+            updates = picked[len(inserts):len(inserts) + drift * self.updates / total]
+            deletes = drift - len(inserts) - len(updates)
+            for i in updates:
+                row = list(target[i])
+                k = rnd.randrange(len(self.key(i)), len(columns))
+                while row[k] == target[i][k]:
+                    row[k] = self.value(rnd, columns[k][1])
+                target[i] = tuple(row)
+            missing = set(inserts)
+            target = [row for i, row in enumerate(target) if i not in missing]
+            target.extend([self.row(rnd, i, columns) for i in xrange(self.options.rows, self.options.rows + deletes)])
+            target_columns = columns
+            if t < self.options.schema_changes:
+                target_columns = columns + [('extra', 'int(11)', 'YES')]
+                target = [row + (0,) for row in target]
+            tables.append(('t%d' % t, columns, target_columns, indexes, source, target))
+            self.planted += drift
+        return tables
+
+
+def load_fake(tables):
+    import fakemysql
+    for (name, source_columns, target_columns, indexes, source_rows, target_rows) in tables:
+        fakemysql.schema('fakemysql', 3306, SOURCE).create(name, source_columns, indexes, source_rows)
+        fakemysql.schema('fakemysql', 3306, TARGET).create(name, target_columns, indexes, target_rows)
+
+
+def load_mysql(options, tables):
+    import MySQLdb
+    connection = MySQLdb.connect(options.host, options.user, options.password, port=options.port)
+    cursor = connection.cursor()
+    for schema in (SOURCE, TARGET):
+        cursor.execute('DROP DATABASE IF EXISTS `%s`' % schema)
+        cursor.execute('CREATE DATABASE `%s` DEFAULT CHARACTER SET utf8' % schema)
+        for (name, source_columns, target_columns, indexes, source_rows, target_rows) in tables:
+            (columns, rows) = (source_columns, source_rows) if schema == SOURCE else (target_columns, target_rows)
+            cursor.execute('CREATE TABLE `%s`.`%s` (%s, PRIMARY KEY (`%s`)) ENGINE=InnoDB' % (
+                schema, name, ', '.join(['`%s` %s%s' % (field, kind, ' NOT NULL' if null == 'NO' else '')
+                                         for (field, kind, null) in columns]),
+                '`, `'.join(indexes[0][2])))
+            insert = 'INSERT INTO `%s`.`%s` VALUES (%s)' % (schema, name, ', '.join(['%s'] * len(columns)))
+            for i in xrange(0, len(rows), 1000):
+                cursor.executemany(insert, rows[i:i + 1000])
+            connection.commit()
+    cursor.close()
+    connection.close()
+
+
+def run(options, mode):
+    """
+    Compare the generated schemas once in mode.
+    @return dict  what to report of the run
+    """
+    import dbff
+    (handle, path) = tempfile.mkstemp(suffix='.json')
+    os.close(handle)
+    (handle, document) = tempfile.mkstemp(suffix='.sql')
+    os.close(handle)
+    host = options.host or 'fakemysql'
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    comparer = dbff.Comparer(host, options.port, SOURCE, options.user, options.password,
+                             host, options.port, TARGET, options.user, options.password,
+                             no_data=False, concurrency=options.concurrency, output_document=document,
+                             mode=mode, backend=options.backend, stats=path)
+    begin = time.time()
+    comparer.start()
+    seconds = time.time() - begin
+    with open(path) as f:
+        stats = json.load(f)
+    os.remove(path)
+    with open(document) as f:
+        statements = len([line for line in f if re.match(r'(INSERT INTO|UPDATE|DELETE FROM) ', line)])
+    os.remove(document)
+    total = stats['total']
+    rows = options.tables * options.rows
+    return {
+        'mode': mode,
+        'seconds': seconds,
+        'rows_per_second': rows / seconds if seconds else 0,
+        'peak_rss_kb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        'start_rss_kb': rss,
+        'phases': stats['phases'],
+        'read': dict([(side, total.get(side, {})) for side in ('source', 'target')]),
+        'changes': dict([(kind, total.get(kind, 0)) for kind in ('insert', 'update', 'delete')]),
+        'statements': statements,
+    }
+
+
+def measure(options, mode):
+    """
+    run in a forked child, so the peak memory of each run is its own.
+    """
+    (read, write) = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        os.close(read)
+        try:
+            result = run(options, mode)
+        except Exception:
+            result = {'mode': mode, 'error': traceback.format_exc()}
+        with os.fdopen(write, 'w') as f:
+            json.dump(result, f)
+        os._exit(0)
+    os.close(write)
+    with os.fdopen(read) as f:
+        data = f.read()
+    os.waitpid(pid, 0)
+    return json.loads(data) if data else {'mode': mode, 'error': 'the run died'}
+
+
+def commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=HERE,
+                                       stderr=open(os.devnull, 'w')).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def show(results, baseline=None):
+    before = dict([(result['mode'], result) for result in (baseline or {}).get('results', [])])
+    print '%-9s %9s %12s %12s %9s %9s %9s %9s' % (
+        'mode', 'seconds', 'rows/s', 'peak RSS MB', 'load', 'plan', 'compare', 'changes')
+    for result in results:
+        if 'error' in result:
+            print '%-9s failed:\n%s' % (result['mode'], result['error'])
+            continue
+        phases = result['phases']
+        print '%-9s %9.3f %12.0f %12.1f %9.3f %9.3f %9.3f %9d' % (
+            result['mode'], result['seconds'], result['rows_per_second'], result['peak_rss_kb'] / 1024.0,
+            phases.get('load', 0), phases.get('plan', 0), phases.get('compare', 0),
+            sum(result['changes'].values()))
+        if result['mode'] in before and 'error' not in before[result['mode']]:
+            old = before[result['mode']]
+            print '%-9s %+8.1f%% %+11.1f%% %+11.1f%%' % (
+                '', 100.0 * (result['seconds'] - old['seconds']) / old['seconds'],
+                100.0 * (result['rows_per_second'] - old['rows_per_second']) / old['rows_per_second'],
+                100.0 * (result['peak_rss_kb'] - old['peak_rss_kb']) / old['peak_rss_kb'])
+
+
+def main():
+    parser = argparse.ArgumentParser(description='dbff benchmark')
+    parser.add_argument('--tables', type=int, default=4, help='tables in each schema')
+    parser.add_argument('--rows', type=int, default=20000, help='rows per source table')
+    parser.add_argument('--width', type=int, default=6, help='int and varchar columns besides the primary key')
+    parser.add_argument('--lobs', type=int, default=1, help='text and blob columns')
+    parser.add_argument('--lob-size', type=int, default=512, help='average bytes of a text or blob value')
+    parser.add_argument('--composite', action='store_true', help='use an (int, varchar) primary key')
+    parser.add_argument('--drift', type=float, default=1, help='percentage of rows differing in the target')
+    parser.add_argument('--mix', default='40,40,20', metavar='INSERT,UPDATE,DELETE',
+                        help='how the drifted rows split into rows to insert, update and delete')
+    parser.add_argument('--schema-changes', type=int, default=1, metavar='N',
+                        help='tables whose target has an extra column')
+    parser.add_argument('--seed', default='1', help='seed of the generated data')
+    parser.add_argument('--modes', default=','.join(['row', 'checksum', 'hash', 'spill']),
+                        help='modes to run, separated by commas')
+    parser.add_argument('--concurrency', type=int, default=4)
+    parser.add_argument('--backend', choices=('thread', 'process'), default='thread')
+    parser.add_argument('--host', help='MySQL server to generate the schemas on, instead of fakemysql; '
+                                       'the %s and %s schemas are dropped first' % (SOURCE, TARGET))
+    parser.add_argument('--port', type=int, default=3306)
+    parser.add_argument('--user', default='root')
+    parser.add_argument('--password', default='')
+    parser.add_argument('--save', metavar='FILE', help='write the results to FILE as JSON')
+    parser.add_argument('--baseline', metavar='FILE', help='show the change against results saved before')
+    options = parser.parse_args()
+
+    if not options.host:
+        import fakemysql
+        fakemysql.install()
+    begin = time.time()
+    generator = Generator(options)
+    tables = generator.tables()
+    if options.host:
+        load_mysql(options, tables)
+    else:
+        load_fake(tables)
+    del tables
+    sys.stderr.write('Generated %d tables of %d rows in %.1f seconds\n' % (
+        options.tables, options.rows, time.time() - begin))
+
+    report = {
+        'commit': commit(),
+        'options': dict([(key, value) for key, value in vars(options).items() if key not in ('save', 'baseline')]),
+        'results': [measure(options, mode) for mode in options.modes.split(',')],
+        'planted': generator.planted,
+    }
+    for result in report['results']:
+        if 'error' in result:
+            continue
+        # sample mode only estimates, and writes no row statement short of --escalate, which the runs do not pass
+        if result['mode'] == 'sample':
+            if result['statements']:
+                result['error'] = 'wrote %d row statements' % result['statements']
+        # a worker dying on a table leaves its changes out rather than failing the run
+        elif sum(result['changes'].values()) != generator.planted:
+            result['error'] = 'found %d changes, %d were planted' % (sum(result['changes'].values()),
+                                                                     generator.planted)
+    baseline = None
+    if options.baseline:
+        with open(options.baseline) as f:
+            baseline = json.load(f)
+        if baseline['options'] != report['options']:
+            sys.stderr.write('Warning: %s was run with other options\n' % options.baseline)
+    show(report['results'], baseline)
+    if options.save:
+        with open(options.save, 'w') as f:
+            json.dump(report, f, indent=2, sort_keys=True)
+    if [result for result in report['results'] if 'error' in result]:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,275 @@
+#-*- encoding=utf8 -*-
+"""
+An in-process stand-in for the part of MySQLdb dbff uses, keeping each schema in an in-memory sqlite database,
+so the benchmark runs without a MySQL server. Call install() before importing dbff.
+"""
+import hashlib
+import random
+import re
+import sqlite3
+import sys
+import threading
+import types
+import zlib
+
+# schemas by (host, port, name)
+SERVERS = {}
+# sqlite connections are shared by threads, one statement at a time
+LOCK = threading.RLock()
+MAX_ALLOWED_PACKET = 16777216
+
+
+class Error(Exception):
+    pass
+
+
+class OperationalError(Error):
+    pass
+
+
+class DictCursor(object):
+    pass
+
+
+class SSCursor(object):
+    pass
+
+
+class BitXor(object):
+    def __init__(self):
+        self.value = 0
+
+    def step(self, value):
+        if value is not None:
+            self.value ^= int(value)
+
+    def finalize(self):
+        return self.value
+
+
+class Schema(object):
+    def __init__(self):
+        self.db = sqlite3.connect(':memory:', check_same_thread=False)
+        self.db.text_factory = str
+        self.db.create_function('CRC32', 1, lambda value: None if value is None else zlib.crc32(text(value)) & 0xffffffff)
+        self.db.create_function('MD5', 1, lambda value: None if value is None else hashlib.md5(text(value)).hexdigest())
+        self.db.create_function('UNHEX', 1, lambda value: None if value is None else buffer(text(value).decode('hex')))
+        self.db.create_function('MY_ISNULL', 1, lambda value: int(value is None))
+        self.db.create_function('CONCAT_WS', -1, lambda sep, *values: concat(text(sep).join(
+            [text(value) for value in values if value is not None]), values))
+        self.db.create_function('CONCAT', -1, lambda *values: None if None in values else concat(
+            ''.join(map(text, values)), values))
+        self.db.create_function('RAND', 0, random.random)
+        self.db.create_aggregate('BIT_XOR', 1, BitXor)
+        # (columns, indexes, engine, comment) by table name, in the shape of information_schema rows
+        self.tables = {}
+
+    def create(self, name, columns, indexes, rows=(), engine='InnoDB', comment=''):
+        """
+        @param columns list  (field, type, null) of each column, null YES or NO
+        @param indexes list  (key_name, non_unique, [column, ...]) of each index
+        @param rows    list  tuples of the values of each row
+        """
+        definitions = []
+        for (field, kind, null) in columns:
+            collation = 'utf8_general_ci' if re.match(r'(var)?char|text|enum|set', kind) else None
+            definitions.append((field, kind, collation, null, '', None, '', 'select,insert,update,references', ''))
+        self.tables[name] = (definitions, indexes, engine, comment)
+        self.db.execute('CREATE TABLE `%s` (%s)' % (name, ', '.join(
+            ['`%s` %s' % (field, affinity(kind)) for (field, kind, null) in columns])))
+        # bytes bound as str would be stored as TEXT, which sqlite hands the functions above as unicode, if at all
+        binary = [affinity(kind) == 'BLOB' for (field, kind, null) in columns]
+        rows = (tuple([sqlite3.Binary(value) if blob and isinstance(value, str) else value
+                       for blob, value in zip(binary, row)]) for row in rows)
+        self.db.executemany('INSERT INTO `%s` VALUES (%s)' % (name, ','.join('?' * len(columns))), rows)
+        self.db.commit()
+
+    def status(self, name):
+        (definitions, indexes, engine, comment) = self.tables[name]
+        count = self.db.execute('SELECT COUNT(*) FROM `%s`' % name).fetchone()[0]
+        return (name, engine, 10, 'Dynamic', count, 100, count * 100, 0, 0, 0, None, None, None, None,
+                'utf8_general_ci', None, '', comment)
+
+    def statistics(self, name):
+        rows = []
+        for (key_name, non_unique, fields) in self.tables[name][1]:
+            for i, field in enumerate(fields):
+                rows.append((name, non_unique, key_name, i + 1, field, 'A', 0, None, None, '', 'BTREE', '', ''))
+        return rows
+
+
+def text(value):
+    """
+    @return str  value as the MySQL string functions see it, the bytes of a blob included
+    """
+    if isinstance(value, buffer):
+        return str(value)
+    if isinstance(value, unicode):
+        return value.encode('utf8')
+    return str(value)
+
+
+def concat(result, values):
+    """
+    @return  result as a blob when any of values is one, like MySQL, so sqlite does not take the bytes for UTF-8 text
+    """
+    return buffer(result) if [value for value in values if isinstance(value, buffer)] else result
+
+
+def affinity(kind):
+    if 'int' in kind:
+        return 'INTEGER'
+    if 'blob' in kind or 'binary' in kind:
+        return 'BLOB'
+    if kind.startswith(('float', 'double', 'real', 'decimal')):
+        return 'REAL'
+    return 'TEXT'
+
+
+def schema(host, port, name):
+    return SERVERS.setdefault((host, int(port), name), Schema())
+
+
+def escape_string(s):
+    return s.replace("'", "''")
+
+
+def translate(sql):
+    """
+    Turn the MySQL only parts of the statements dbff sends into sqlite.
+    """
+    sql = re.sub(r'\bBINARY\s+', '', sql)
+    sql = re.sub(r'\bISNULL\(', 'MY_ISNULL(', sql)
+    sql = re.sub(r'AS UNSIGNED\)', 'AS INTEGER)', sql)
+    sql = re.sub(r'\b0x([0-9a-fA-F]+)', r"X'\1'", sql)
+    return sql
+
+
+class Cursor(object):
+    def __init__(self, connection, dictionary=False):
+        self.connection = connection
+        self.dictionary = dictionary
+        self.rows = []
+        self.description = None
+        self.rowcount = -1
+
+    def execute(self, sql, args=None):
+        schema = self.connection.schema
+        statement = sql.strip().rstrip(';').strip()
+        low = statement.lower()
+        (names, rows) = (None, [])
+        quoted = re.search(r'`([^`]*)`', statement)
+        if low.startswith(('set ', 'start ')) or low in ('commit', 'rollback', 'begin'):
+            pass
+        elif low.startswith('select @@max_allowed_packet'):
+            (names, rows) = (['max_allowed_packet'], [(MAX_ALLOWED_PACKET,)])
+        elif low.startswith('select version()'):
+            (names, rows) = (['version'], [('5.7.0-fakemysql',)])
+        elif low.startswith('show table status'):
+            like = re.search(r"like '([^']*)'", statement)
+            rows = [schema.status(name) for name in sorted(schema.tables) if not like or like.group(1) == name]
+        elif low.startswith('show full columns from'):
+            rows = list(schema.tables[quoted.group(1)][0])
+        elif low.startswith('show index from'):
+            rows = schema.statistics(quoted.group(1))
+        elif low.startswith('show create table'):
+            name = quoted.group(1)
+            rows = [(name, 'CREATE TABLE `%s` (\n%s\n)' % (name, ',\n'.join(
+                ['`%s` %s' % (column[0], column[1]) for column in schema.tables[name][0]])))]
+        elif low.startswith('checksum table'):
+            # no live checksum, like InnoDB
+            rows = [('%s.%s' % (self.connection.name, quoted.group(1)), None)]
+        elif 'information_schema' in low:
+            rows = self.information_schema(statement)
+        else:
+            with LOCK:
+                try:
+                    cursor = schema.db.execute(translate(statement), args or ())
+                except sqlite3.Error, err:
+                    raise OperationalError(1064, '%s in: %s' % (err, statement[:200]))
+                rows = cursor.fetchall() if cursor.description else []
+                # MySQLdb returns binary values as str
+                rows = [tuple([str(value) if isinstance(value, buffer) else value for value in row]) for row in rows]
+                names = [column[0] for column in cursor.description] if cursor.description else None
+                self.rowcount = cursor.rowcount
+                schema.db.commit()
+        if names is None and rows:
+            names = ['c%d' % i for i in range(len(rows[0]))]
+        self.description = [(name,) for name in names] if names else None
+        if self.dictionary:
+            rows = [dict(zip(names, row)) for row in rows]
+        self.rows = list(rows)
+        return len(self.rows)
+
+    def information_schema(self, sql):
+        schema = self.connection.schema
+        low = sql.lower()
+        names = sorted(schema.tables)
+        only = re.search(r"table_name in \(([^)]*)\)", low)
+        if only:
+            names = [name for name in names if name in re.findall(r"'([^']*)'", sql[only.start():only.end()])]
+        skip = re.search(r"table_name not in \(([^)]*)\)", low)
+        if skip:
+            names = [name for name in names if name not in re.findall(r"'([^']*)'", sql[skip.start():skip.end()])]
+        if 'information_schema.tables' in low:
+            return [schema.status(name) for name in names]
+        if 'information_schema.columns' in low:
+            return [(name,) + column for name in names for column in schema.tables[name][0]]
+        if 'information_schema.statistics' in low:
+            return [row for name in names for row in schema.statistics(name)]
+        return []
+
+    def fetchall(self):
+        (rows, self.rows) = (self.rows, [])
+        return rows
+
+    def fetchone(self):
+        return self.rows.pop(0) if self.rows else None
+
+    def fetchmany(self, size=1):
+        (rows, self.rows) = (self.rows[:size], self.rows[size:])
+        return rows
+
+    def close(self):
+        self.rows = []
+
+
+class Connection(object):
+    def __init__(self, host, user=None, passwd=None, db=None, port=3306, **kwargs):
+        self.name = db
+        self.schema = schema(host, port, db)
+
+    def cursor(self, cursorclass=None):
+        return Cursor(self, cursorclass is DictCursor)
+
+    def ping(self, reconnect=False):
+        return True
+
+    def autocommit(self, on):
+        pass
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        pass
+
+
+def connect(*args, **kwargs):
+    return Connection(*args, **kwargs)
+
+
+def install():
+    """
+    Make this module what import MySQLdb and MySQLdb.cursors return.
+    """
+    module = sys.modules[__name__]
+    cursors = types.ModuleType('MySQLdb.cursors')
+    cursors.DictCursor = DictCursor
+    cursors.SSCursor = SSCursor
+    module.cursors = cursors
+    sys.modules['MySQLdb'] = module
+    sys.modules['MySQLdb.cursors'] = cursors
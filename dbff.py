@@ -4,18 +4,34 @@ import MySQLdb
 from MySQLdb.cursors import DictCursor, SSCursor
 import Queue
 import atexit
-import cStringIO
+import binascii
+import bisect
 import copy
+import cPickle
+import hashlib
+import heapq
+import itertools
+import json
 import logging
+import mmap
+import multiprocessing
+import operator
 import re
 import shlex
 import shutil
 import subprocess
 import os
+import random
 import tempfile
 import threading
 import sys
 import time
+import urllib
+import zlib
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 __version__ = "1.4.4"
 
@@ -27,7 +43,13 @@ class Comparer():
                  target_host, target_port, target_schema,
                  target_username, target_password,
                  no_data, concurrency=4, whitelist=None, blacklist=None,
-                 output_document=None, verbose=False):
+                 output_document=None, verbose=False, mode='row', chunk_size=10000, max_allowed_packet=None,
+                 split_size=1000000, max_memory=256, precheck=False, backend='thread', max_connections=None,
+                 state_dir=None, watermark=None, watermark_file='dbff.watermarks', ignore_columns=None,
+                 digest_columns=None, length_columns=None, where=None, apply=False, apply_size=1000, stats=None,
+                 progress=False, samples=20, sample_size=1000, escalate=None, targets=None, source_snapshot=None,
+                 target_snapshot=None, snapshot=None, snapshot_digests=False, output_dir=None, compress=None,
+                 max_file_size=None):
         self.source_host = source_host
         self.source_port = int(source_port)
         self.source_schema = source_schema
@@ -48,111 +70,1083 @@ class Comparer():
             self.blacklist = re.split('\s*,\s*', blacklist)
         else:
             self.blacklist = None
-        if output_document and output_document != "-":
+        # what is written to output_dir, as Directory.manifest
+        self.manifest = []
+        # what went wrong in a run that otherwise went on to the end, to fail it once done
+        self.failures = []
+        if output_dir and output_document:
+            raise Exception('Give either an output document or an output directory')
+        if compress and not output_dir:
+            raise Exception('Only the files of an output directory can be compressed')
+        if compress == 'zstd' and zstandard is None:
+            raise Exception('zstd compression needs the zstandard module')
+        if output_dir:
+            self.output_document = Directory(output_dir, self.manifest, compress,
+                                             int(max_file_size) * 1024 * 1024 if max_file_size else None)
+        elif output_document and output_document != "-":
             self.output_document = open(output_document, "w")
+        elif apply and not output_document:
+            self.output_document = None
         else:
             self.output_document = sys.stdout
+        # (host, port, schema, output document) of each target, compared against the same source in one pass
+        self.targets = [(self.target_host, self.target_port, self.target_schema, self.output_document)]
+        for spec in targets or []:
+            (host, port, schema, document) = Comparer.target(spec)
+            if document and document != "-":
+                document = open(document, "w")
+            elif document == "-":
+                document = sys.stdout
+            elif apply:
+                document = None
+            else:
+                raise Exception('Give target %s an output document of its own, as %s=FILE' % (spec, spec))
+            self.targets.append((host, port, schema, document))
+        if len(self.targets) > 1 and state_dir:
+            raise Exception('A state directory can not be used with more than one target')
+        # directories of snapshots compared in place of the source or the first target, and to export the source to
+        self.source_snapshot = source_snapshot
+        self.target_snapshot = target_snapshot
+        self.snapshot = snapshot
+        self.snapshot_digests = snapshot_digests
+        if (source_snapshot or target_snapshot) and (where or watermark):
+            raise Exception('The rows of a snapshot can not be compared by a where condition or a watermark')
+        if target_snapshot and apply:
+            raise Exception('Changes can not be applied to a snapshot')
         self.verbose = verbose
+        self.mode = mode
+        self.chunk_size = int(chunk_size)
+        self.max_allowed_packet = int(max_allowed_packet) if max_allowed_packet else None
+        self.split_size = int(split_size)
+        self.max_memory = int(max_memory) * 1024 * 1024
+        self.precheck = precheck
+        self.backend = backend
+        self.max_connections = int(max_connections) if max_connections else None
+        if self.max_connections:
+            # every schema of a server counts against the same cap, and a job holds one to each side at once
+            servers = ([] if source_snapshot else [(self.source_host, int(self.source_port))]) + [
+                (host, int(port)) for i, (host, port, schema, document) in enumerate(self.targets)
+                if i or not target_snapshot]
+            busiest = max([servers.count(server) for server in servers] or [0])
+            if self.max_connections < busiest:
+                raise Exception('Give --max-connections at least %d, each job holds that many connections to one '
+                                'server' % busiest)
+        self.state_dir = state_dir
+        # watermark column by table name, None holding the column of tables not named
+        self.watermark = dict(Comparer.per_table(watermark))
+        self.watermark_file = watermark_file
+        self.ignore_columns = Comparer.per_table(ignore_columns)
+        self.digest_columns = [(name, column, 'MD5') for (name, column) in Comparer.per_table(digest_columns)] + \
+                              [(name, column, 'LENGTH') for (name, column) in Comparer.per_table(length_columns)]
+        # condition by table name, each given as TABLE:CONDITION
+        self.where = dict([item.split(':', 1) for item in where or []])
+        self.apply = apply
+        self.apply_size = int(apply_size)
+        self.stats = Stats(progress)
+        self.stats_file = stats
+        self.samples = int(samples)
+        self.sample_size = int(sample_size)
+        self.escalate = float(escalate) if escalate is not None else None
         self.logger = logging.getLogger("comparer")
         logging.basicConfig(level=logging.ERROR, stream=sys.stdout, format='[%(asctime)s] [%(levelname)s] %(message)s')
         if self.verbose:
             self.logger.level = logging.DEBUG
-        self.manifest = []
 
     def start(self):
         start_time = time.time()
 
-        if not self.source_schema or not self.target_schema:
+        if self.snapshot:
+            self.export()
+            self.logger.info('Exported the source to %s in %0.4f seconds.', self.snapshot, time.time() - start_time)
+            return
+
+        if not self.source_schema and not self.source_snapshot or not self.target_schema and not self.target_snapshot:
             self.logger.warn('Source or target not specified, is this a mistake?')
             exit(128)
 
-        result = self.build()
+        self.build()
 
-        if self.output_document is not None:
-            self.output_document.write(result)
         self.logger.info('')
         self.logger.info('All complete in %0.4f seconds.', time.time() - start_time)
+        if self.mode == 'sample':
+            for name, metrics in sorted(self.stats.tables.items()):
+                if 'sample' in metrics:
+                    sys.stderr.write('%s: %s\n' % (name, Stats.estimate(**metrics['sample'])))
+        if len(self.targets) > 1:
+            for (host, port, schema, document) in self.targets:
+                label = '%s:%d/%s' % (host, port, schema)
+                sys.stderr.write('%s: %s\n' % (label, self.stats.divergence(label)))
+        if self.stats_file:
+            self.stats.report(self.stats_file)
+            self.logger.info('Wrote run stats to %s', self.stats_file)
+        if self.failures:
+            raise Exception('; '.join(self.failures))
+
+    def pool(self, server, pools):
+        """
+        @param pools dict  the first ConnectionPool of each (host, port), whose --max-connections later schemas of
+                           the same server share
+        @return ConnectionPool  of the schema of server
+        """
+        shared = pools.get((server[0], int(server[4])))
+        pool = ConnectionPool(server, self.logger, self.max_connections, shared)
+        pools.setdefault((server[0], int(server[4])), pool)
+        return pool
 
     def build(self):
-        source = Database(
-            (
-                self.source_host,
-                self.source_username,
-                self.source_password,
-                self.source_schema,
-                self.source_port,
-            ), self.logger
+        begin = time.time()
+        pools = {}
+        server = (
+            self.source_host,
+            self.source_username,
+            self.source_password,
+            self.source_schema,
+            self.source_port,
         )
-        target = Database(
-            (
-                self.target_host,
+        if self.source_snapshot:
+            source = Snapshot(self.source_snapshot, self.logger, whitelist=self.whitelist, blacklist=self.blacklist)
+        else:
+            source = Database(server, self.logger, whitelist=self.whitelist, blacklist=self.blacklist,
+                              pool=self.pool(server, pools))
+        targets = []
+        for (host, port, schema, document) in self.targets:
+            server = (
+                host,
                 self.target_username,
                 self.target_password,
-                self.target_schema,
-                self.target_port,
-            ), self.logger
-        )
+                schema,
+                port,
+            )
+            if self.target_snapshot and not targets:
+                targets.append(Snapshot(self.target_snapshot, self.logger, whitelist=self.whitelist,
+                                        blacklist=self.blacklist))
+                continue
+            targets.append(Database(server, self.logger, whitelist=self.whitelist, blacklist=self.blacklist,
+                                    pool=self.pool(server, pools)))
+        labels = ['%s:%d/%s' % (host, port, schema) for (host, port, schema, document) in self.targets]
+        begin = self.stats.phase('load', begin)
         queue = Queue.Queue()
         self.logger.info('Building dbffer queue...')
-        self.logger.info("Compare between MySQL server %s with %s", source.version, target.version)
+        self.logger.info("Compare between MySQL server %s with %s", source.version,
+                         ', '.join([target.version for target in targets]))
+        max_allowed_packet = self.max_allowed_packet or min([target.max_allowed_packet for target in targets])
+        self.logger.info('Batching statements up to %d bytes', max_allowed_packet)
 
         blacklist = self.blacklist
+        # each unit holds the table of every target, None where a target does not have it
+        units = []
         for name, table in source.tables.items():
             if blacklist and name in blacklist:
                 continue
-            if name in target.tables:
-                queue.put((table, target.tables[name]))
+            tables = [target.tables.get(name) for target in targets]
+            ranges = self.split(source, table, tables)
+            for i, (lower, upper) in enumerate(ranges):
+                part = (i, len(ranges), lower, upper) if len(ranges) > 1 else None
+                units.append(((table.data_length or 0) / len(ranges), table, tables, part))
+        names = set()
+        for target in targets:
+            for name in target.tables:
+                if blacklist and name in blacklist or name in source.tables or name in names:
+                    continue
+                names.add(name)
+                units.append((0, None, [item.tables.get(name) for item in targets], None))
+        # largest first, so the biggest tables do not keep a single worker busy after the others are done
+        units.sort(key=lambda unit: unit[0], reverse=True)
+        state = None
+        if self.state_dir:
+            state = State(self.state_dir, self.fingerprint(), self.logger)
+            units = state.plan(units, source, targets[0])
+        (pending, done) = [], []
+        for (size, source_table, target_tables, part) in units:
+            name = unit_name(source_table, target_tables)
+            if state is not None and state.done(name, part):
+                done.append((name, part))
             else:
-                queue.put((table, None))
-        for name, table in target.tables.items():
-            if blacklist and name in blacklist:
-                continue
-            if name not in source.tables:
-                queue.put((None, table))
+                pending.append((source_table, target_tables, part))
+                queue.put((source_table, target_tables if len(targets) > 1 else target_tables[0], part))
+        if done:
+            self.logger.info('%d of %d units already done in %s', len(done), len(units), self.state_dir)
+        (watermarks, marks, seen) = ([{} for target in targets], {}, [])
+        if self.watermark:
+            for (host, port, schema, document) in self.targets:
+                seen.append(Watermarks(self.watermark_file, '%s:%d/%s>%s:%d/%s' % (
+                    self.source_host, self.source_port, self.source_schema, host, port, schema)))
+            for name, table in source.tables.items():
+                column = self.watermark.get(name, self.watermark.get(None))
+                having = [i for i, target in enumerate(targets) if name in target.tables]
+                if not having or blacklist and name in blacklist or \
+                        column not in [item.field for item in table.columns]:
+                    continue
+                # read before any row is, so rows changed while comparing are compared again next run
+                marks[name] = self.high_water(source, table, column)
+                for i in having:
+                    watermarks[i][name] = (column, seen[i].get(name))
         self.logger.info('Starting dbffer...')
+        begin = self.stats.phase('plan', begin)
+        self.stats.plan(units, labels)
 
-        workers = []
-        buf = cStringIO.StringIO()
-        l = threading.Lock()
-        for i in xrange(self.concurrency):
-            dbffer = Dbffer(source.clone(), target.clone(),
-                            queue, buf, l,
-                            no_data=self.no_data,
-                            blacklist=blacklist,
-                            whitelist=self.whitelist)
-            dbffer.start()
-            workers.append(dbffer)
-        self.logger.info('Waiting for dbffer complete...')
-        for w in workers:
-            w.join()
-        self.logger.info("Done!")
+        options = dict(no_data=self.no_data,
+                       blacklist=blacklist,
+                       whitelist=self.whitelist,
+                       mode=self.mode,
+                       chunk_size=self.chunk_size,
+                       max_allowed_packet=max_allowed_packet,
+                       max_memory=self.max_memory,
+                       precheck=self.precheck,
+                       ignore_columns=self.ignore_columns,
+                       digest_columns=self.digest_columns,
+                       where=self.where,
+                       samples=self.samples,
+                       sample_size=self.sample_size,
+                       escalate=self.escalate)
+        # the same for every target but the watermarks seen of it
+        options = [dict(options, watermarks=item) for item in watermarks]
+        # hand the connections used for loading over to the first workers
+        source.release()
+        for target in targets:
+            target.release()
+        pool = None
+        if self.backend == 'process':
+            # forked before the writer thread starts, so no child inherits a lock that thread holds
+            pool = multiprocessing.Pool(self.concurrency, process_init, (source, targets, options))
+
+        # bounded, so workers that outpace the output documents wait instead of piling up results
+        outputs = [Queue.Queue(self.concurrency * 2) for target in targets]
+        (appliers, changes) = ([[] for target in targets], [None for target in targets])
+        if self.apply:
+            for i, target in enumerate(targets):
+                # not bounded, a writer waiting for busy appliers would keep workers holding connections waiting too
+                changes[i] = Queue.Queue()
+                for j in xrange(self.concurrency):
+                    # from the pool of the workers, so --max-connections holds for the appliers too
+                    applier = Applier(target.pool, changes[i], self.logger, self.apply_size, self.stats,
+                                      state if i == 0 else None)
+                    applier.start()
+                    appliers[i].append(applier)
+        writers = []
+        for (host, port, schema, document), output, change, label in zip(self.targets, outputs, changes, labels):
+            writer = Writer(document, output, self.logger, state, change, self.stats, label)
+            writer.start()
+            writers.append(writer)
 
-        if buf.getvalue() != '':
-            self.logger.info('Dumping compare result...')
-            return "\n".join([
-                "/*!40101 SET NAMES utf8 */;",
-                "",
-                "/*!40101 SET SQL_MODE=''*/;",
-                "",
-                "/*!40014 SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0 */;",
-                "/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;",
-                "/*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;",
-                "/*!40111 SET @OLD_SQL_NOTES=@@SQL_NOTES, SQL_NOTES=0 */;",
-                "",
-                buf.getvalue(),
-                "/*!40101 SET SQL_MODE=@OLD_SQL_MODE */;",
-                "/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;",
-                "/*!40014 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS */;",
-                "/*!40111 SET SQL_NOTES=@OLD_SQL_NOTES */;", "\n"
-            ])
+        if pool is not None:
+            self.resume(state, done, outputs[0])
+            self.logger.info('Waiting for dbffer processes complete...')
+            units = [(s.name if s is not None else None, [t.name if t is not None else None for t in ts], part)
+                     for (s, ts, part) in pending]
+            failed = []
+            for (name, results) in pool.imap_unordered(process_compare, units):
+                if results is None:
+                    failed.append(name)
+                    continue
+                for output, result in zip(outputs, results):
+                    if result is not None:
+                        output.put(result)
+            pool.close()
+            pool.join()
         else:
+            workers = []
+            for i in xrange(self.concurrency):
+                if len(targets) > 1:
+                    # one source connection for all lanes, so a worker holds no more than one of each server
+                    shared = source.clone()
+                    worker = Fanout([Dbffer(shared, target.clone(), None, None, **lane)
+                                     for target, lane in zip(targets, options)], queue, outputs)
+                else:
+                    worker = Dbffer(source.clone(), targets[0].clone(), queue, outputs[0], **options[0])
+                worker.start()
+                workers.append(worker)
+            self.resume(state, done, outputs[0])
+            self.logger.info('Waiting for dbffer complete...')
+            for w in workers:
+                w.join()
+            failed = sum([w.failed for w in workers], [])
+        if failed:
+            # the writers leave out the rest of these tables, and the parts of them that did get compared
+            self.failures.append('Failed to compare %d tables: %s' % (len(failed), ', '.join(sorted(set(failed)))))
+            self.logger.error(self.failures[-1])
+        for output in outputs:
+            output.put(None)
+        for writer in writers:
+            writer.join()
+        if isinstance(self.output_document, Directory):
+            self.output_document.close()
+            self.logger.info('Wrote %d files to %s', len(self.manifest), self.output_document.path)
+        begin = self.stats.phase('compare', begin)
+        for change, applying in zip(changes, appliers):
+            for applier in applying:
+                change.put(None)
+        for applier in sum(appliers, []):
+            applier.join()
+        if self.apply:
+            self.stats.phase('apply', begin)
+        self.stats.finish()
+        failed = [sum([applier.failed for applier in applying], []) for applying in appliers]
+        for label, names in zip(labels, failed):
+            if names:
+                self.failures.append('Failed to apply the changes of %d tables to %s: %s' % (
+                    len(names), label, ', '.join(names)))
+                self.logger.error(self.failures[-1])
+        self.logger.info("Done!")
+
+        for i, writer in enumerate(writers):
+            # a table whose changes did not all make it to the target is compared in full again next run
+            finished = dict([(name, mark) for name, mark in marks.items()
+                             if name in watermarks[i] and name in writer.finished and name not in failed[i] and
+                             mark is not None])
+            if finished:
+                seen[i].save(finished)
+                self.logger.info('Saved the watermarks of %d tables of %s to %s', len(finished), labels[i],
+                                 self.watermark_file)
+
+        tables = sum([writer.tables for writer in writers])
+        if not tables:
             self.logger.info('No difference between source and target.')
-            return ""
+        return tables
+
+    @staticmethod
+    def resume(state, done, output):
+        """
+        Hand the units already done in state to the writer again, in the chunks they were written in.
+        """
+        for (name, part) in done:
+            chunks = state.load(name, part)
+            for chunk in chunks[:-1]:
+                output.put((name, part, chunk, None))
+            output.put((name, part, chunks[-1], {}))
+
+    def fingerprint(self):
+        """
+        Identify the arguments that decide what a run writes, so a state directory is only resumed by the same run.
+        """
+        return hashlib.md5(repr((
+            self.source_host, self.source_port, self.source_schema,
+            self.target_host, self.target_port, self.target_schema,
+            self.no_data, self.whitelist, self.blacklist, self.mode, self.chunk_size,
+            self.max_allowed_packet, self.split_size, self.precheck, self.watermark,
+            self.ignore_columns, self.digest_columns, self.where, self.samples, self.sample_size, self.escalate,
+            [(host, port, schema) for (host, port, schema, document) in self.targets],
+            self.source_snapshot, self.target_snapshot,
+        ))).hexdigest()
+
+    def export(self):
+        server = (
+            self.source_host,
+            self.source_username,
+            self.source_password,
+            self.source_schema,
+            self.source_port,
+        )
+        source = Database(server, self.logger, whitelist=self.whitelist, blacklist=self.blacklist)
+        Snapshot.export(source, self.snapshot, self.logger, self.snapshot_digests)
+        source.close()
+
+    @staticmethod
+    def per_table(value):
+        """
+        Parse COLUMN and TABLE.COLUMN items separated by commas.
+        @return list  of (table, column), table None for the items meaning every table having the column
+        """
+        if value is None or value == "":
+            return []
+        return [tuple(item.split('.', 1)) if '.' in item else (None, item) for item in re.split('\s*,\s*', value)]
+
+    @staticmethod
+    def target(spec):
+        """
+        Parse a target given as HOST[:PORT]/SCHEMA[=FILE].
+        @return tuple  (host, port, schema, output document name or None)
+        """
+        match = re.match(r'^([^:/=]+)(?::(\d+))?/([^=]+)(?:=(.+))?$', spec)
+        if match is None:
+            raise Exception('Target %s is not given as HOST[:PORT]/SCHEMA[=FILE]' % spec)
+        (host, port, schema, document) = match.groups()
+        return host, int(port or 3306), schema, document
+
+    def high_water(self, db, table, column):
+        cursor = db.connection.cursor(SSCursor)
+        cursor.execute('SELECT MAX(`%s`) FROM `%s`' % (column, table.name))
+        (mark,) = cursor.fetchall()[0]
+        cursor.close()
+        return mark
+
+    def split(self, db, source, targets):
+        """
+        Split a table with a big integer primary key into primary key ranges of about split_size rows,
+        so several workers can compare it at once.
+        @param targets list  the table in each target, which must all have the primary key of source
+        @return list  of (lower, upper) ranges as accepted by Table.key_range
+        """
+        if self.no_data or not self.split_size or source.rows <= self.split_size or len(source.pk_fields) != 1 or \
+                [target for target in targets
+                 if target is None or source.indexes.get('PRIMARY') != target.indexes.get('PRIMARY')]:
+            return [(None, None)]
+        if not [column for column in source.columns
+                if column.field == source.pk_fields[0] and re.match(r'(tiny|small|medium|big)?int\b', column.type)]:
+            return [(None, None)]
+        if isinstance(db, Snapshot):
+            (low, high) = [key[0] if key is not None else None for key in db.span(source)]
+        else:
+            cursor = db.connection.cursor(SSCursor)
+            cursor.execute('SELECT MIN(`%s`), MAX(`%s`) FROM `%s`' % (
+                source.pk_fields[0], source.pk_fields[0], source.name))
+            (low, high) = cursor.fetchall()[0]
+            cursor.close()
+        if low is None:
+            return [(None, None)]
+        count = min((source.rows + self.split_size - 1) / self.split_size, high - low + 1)
+        step = (high - low + 1) / count
+        bounds = [None] + [(low + step * i - 1,) for i in xrange(1, count)] + [None]
+        self.logger.debug('Split table %s into %d ranges', source.name, count)
+        return zip(bounds[:-1], bounds[1:])
+
+
+class Writer(threading.Thread):
+    HEADER = [
+        "/*!40101 SET NAMES utf8 */;",
+        "",
+        "/*!40101 SET SQL_MODE=''*/;",
+        "",
+        "/*!40014 SET @OLD_UNIQUE_CHECKS=@@UNIQUE_CHECKS, UNIQUE_CHECKS=0 */;",
+        "/*!40014 SET @OLD_FOREIGN_KEY_CHECKS=@@FOREIGN_KEY_CHECKS, FOREIGN_KEY_CHECKS=0 */;",
+        "/*!40101 SET @OLD_SQL_MODE=@@SQL_MODE, SQL_MODE='NO_AUTO_VALUE_ON_ZERO' */;",
+        "/*!40111 SET @OLD_SQL_NOTES=@@SQL_NOTES, SQL_NOTES=0 */;",
+    ]
+    FOOTER = [
+        "/*!40101 SET SQL_MODE=@OLD_SQL_MODE */;",
+        "/*!40014 SET FOREIGN_KEY_CHECKS=@OLD_FOREIGN_KEY_CHECKS */;",
+        "/*!40014 SET UNIQUE_CHECKS=@OLD_UNIQUE_CHECKS */;",
+        "/*!40111 SET SQL_NOTES=@OLD_SQL_NOTES */;",
+    ]
+
+    def __init__(self, output_document, queue, logger, state=None, changes=None, stats=None, label=None):
+        """
+        Write the SQL of each table to output_document as soon as a worker puts it on queue, until a None arrives.
+        A worker may put the statements of a unit in several chunks as they are built, each but the last carrying
+        None for metrics, and the chunks of a split table are written part after part. Either way the updates and
+        inserts of a table are held back until it is done, so they run after every delete of it.
+        @param state   State        where to record each finished unit, if the run should be resumable
+        @param changes Queue.Queue  where to put the (name, statements) of each table to apply them to the target
+        @param stats   Stats        where to add the metrics of each unit
+        @param label   str          the target in stats, as HOST:PORT/SCHEMA
+        """
+        self.output_document = output_document
+        self.queue = queue
+        self.logger = logger
+        self.state = state
+        self.changes = changes
+        self.stats = stats or Stats()
+        self.label = label
+        self.tables = 0
+        # names of the tables whose every part is done, whether they differ or not
+        self.finished = set()
+        # [part to write next, chunks held back by part, parts whose last chunk came] of each split table
+        self.parts = {}
+        # statements written so far of each table not done yet, only held to hand them to the appliers
+        self.open = {}
+        # temporary file of the (updates, inserts) of each chunk of a table not done yet
+        self.held = {}
+        threading.Thread.__init__(self)
+
+    @staticmethod
+    def sql(name, statements):
+        """
+        @return list  statements turning the target table into the source one, in the order to run them
+        """
+        (create, drop, truncate, alter, delete, update, insert) = statements
+        if alter:
+            alter = ['ALTER TABLE `%s` %s' % (name, ', '.join(alter))]
+        return create + drop + truncate + alter + delete + update + insert
+
+    def order(self, name, part, statements, last):
+        """
+        @return list  (statements, whether the table is done) of each chunk to write now, holding back the chunks
+                      of a part of a split table until every part before it is done
+        """
+        if part is None:
+            return [(statements, last)]
+        (index, count) = part[:2]
+        (held, ready) = (self.parts.setdefault(name, [0, {}, set()]), [])
+        held[1].setdefault(index, []).append(statements)
+        if last:
+            held[2].add(index)
+        while held[0] < count:
+            ready.extend([(chunk, False) for chunk in held[1].pop(held[0], [])])
+            if held[0] not in held[2]:
+                break
+            held[0] += 1
+        if held[0] == count:
+            del self.parts[name]
+            ready.append(([[] for kind in statements], True))
+        return ready
+
+    def write(self, data):
+        if self.output_document is not None:
+            self.output_document.write(data)
+            self.output_document.flush()
+
+    def emit(self, name, statements, done):
+        """
+        Write the statements of a chunk, but its updates and inserts only once the table is done: a row whose key
+        moved to another part, or past a batch, keeps its unique values until the row of its old key is deleted.
+        """
+        if done and name not in self.held:
+            self.put(name, statements)
+            return self.finish(name)
+        (update, insert) = statements[5:]
+        if update or insert:
+            if name not in self.held:
+                self.held[name] = tempfile.TemporaryFile()
+            cPickle.dump((update, insert), self.held[name], cPickle.HIGHEST_PROTOCOL)
+        self.put(name, list(statements[:5]) + [[], []])
+        if done:
+            held = self.held.pop(name)
+            # every update of the table, then every insert, a chunk at a time
+            for kind in (5, 6):
+                held.seek(0)
+                while True:
+                    try:
+                        chunk = cPickle.load(held)
+                    except EOFError:
+                        break
+                    statements = [[] for i in xrange(7)]
+                    statements[kind] = chunk[kind - 5]
+                    self.put(name, statements)
+            held.close()
+            self.finish(name)
+
+    def put(self, name, statements):
+        begin = time.time()
+        sql = self.sql(name, statements)
+        # a directory takes the statements to share them out to files, each with its own header and footer
+        split = isinstance(self.output_document, Directory)
+        data = ''.join(['%s;\n' % statement for statement in sql]) if sql and not split else ''
+        self.stats.add(name, {'sql': {'seconds': time.time() - begin}})
+        if sql:
+            if name not in self.open:
+                self.stats.diverged(self.label, name)
+                if not self.tables:
+                    self.logger.info('Dumping compare result...')
+                    if not split:
+                        self.write('%s\n\n' % '\n'.join(self.HEADER))
+                self.logger.debug('Writing table %s', name)
+                self.open[name] = []
+                self.tables += 1
+                data = '/* SYNC TABLE : `%s` */\n%s' % (name, data) if not split else data
+            begin = time.time()
+            if split:
+                size = self.output_document.add(name, sql)
+            else:
+                self.write(data)
+                size = len(data)
+            self.stats.add(name, {'write': {'seconds': time.time() - begin, 'bytes': size}})
+            if self.changes is not None:
+                self.open[name].extend(sql)
+
+    def finish(self, name):
+        self.finished.add(name)
+        if name in self.open:
+            if isinstance(self.output_document, Directory):
+                self.output_document.end(name)
+            else:
+                self.write('\n')
+            applying = self.open.pop(name)
+            if self.changes is not None:
+                self.changes.put((name, applying))
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            (name, part, statements, metrics) = item
+            last = metrics is not None
+            if last:
+                self.stats.finished(name, part, metrics, self.label)
+            if self.state is not None:
+                self.state.save(name, part, statements, last)
+            for (chunk, done) in self.order(name, part, statements, last):
+                self.emit(name, chunk, done)
+        for held in self.held.values():
+            held.close()
+        incomplete = sorted(set(self.open) | set(self.parts) | set(self.held))
+        if incomplete:
+            self.logger.error('The changes of %d tables%s are incomplete, they were not compared to the end: %s',
+                              len(incomplete), ' of %s' % self.label if self.label else '', ', '.join(incomplete))
+        if self.tables and not isinstance(self.output_document, Directory):
+            self.write('\n%s\n\n' % '\n'.join(self.FOOTER))
+
+
+class Directory(object):
+    SUFFIXES = {None: '', 'gzip': '.gz', 'zstd': '.zst'}
+
+    def __init__(self, path, manifest, compress=None, max_file_size=None):
+        """
+        An output directory holding the SQL of each table in files of its own, each a whole output document with
+        Writer.HEADER and Writer.FOOTER, so tables can be loaded in parallel by as many clients.
+        @param manifest      list  where to add the table, file name, statements and bytes on disk of each file
+        @param compress      str   gzip or zstd to compress the files as they are written, None for plain SQL
+        @param max_file_size int   bytes of SQL past which the statements of a table go on in a next file, None
+                                   for one file per table
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self.path = path
+        self.manifest = manifest
+        self.compress = compress
+        self.max_file_size = max_file_size
+        # (file being written, its number) of each table not done yet
+        self.files = {}
+
+    def add(self, name, statements):
+        """
+        Write statements of table name on to NAME.0001.sql, and to NAME.0002.sql and so on when max_file_size
+        would be exceeded, a statement never being cut.
+        @return int  bytes of SQL written, before compression
+        """
+        ((f, number), written) = (self.files.get(name, (None, 0)), 0)
+        for statement in statements:
+            data = '%s;\n' % statement
+            if f is None or self.max_file_size and f.statements and f.size + len(data) > self.max_file_size:
+                if f is not None:
+                    self.seal(name, f)
+                number += 1
+                f = self.open(name, number)
+            f.write(data)
+            f.statements += 1
+            written += len(data)
+        self.files[name] = (f, number)
+        return written
+
+    def end(self, name):
+        """
+        Finish the last file of table name.
+        """
+        (f, number) = self.files.pop(name, (None, 0))
+        if f is not None:
+            self.seal(name, f)
+
+    def open(self, name, number):
+        """
+        @param number int  of the file among those of the table, from 1
+        """
+        f = Compressed(os.path.join(self.path, '%s.%04d.sql%s' % (
+            urllib.quote(name, ''), number, self.SUFFIXES[self.compress])), self.compress)
+        f.write('%s\n\n/* SYNC TABLE : `%s` */\n' % ('\n'.join(Writer.HEADER), name))
+        return f
+
+    def seal(self, name, f):
+        f.write('\n%s\n\n' % '\n'.join(Writer.FOOTER))
+        self.manifest.append({
+            'table': name,
+            'file': os.path.basename(f.path),
+            'statements': f.statements,
+            'bytes': f.close(),
+        })
+
+    def close(self):
+        """
+        Write the manifest, listing the files of each table in the order to load them.
+        """
+        with open(os.path.join(self.path, 'manifest.json'), 'w') as f:
+            json.dump({
+                'version': __version__,
+                'compress': self.compress,
+                'files': self.manifest,
+            }, f, indent=2, sort_keys=True)
+
+
+class Compressed(object):
+    def __init__(self, path, compress=None):
+        """
+        A file compressed as it is written.
+        @param compress str  gzip or zstd, None to write data as it is
+        """
+        self.path = path
+        self.file = open(path, 'wb')
+        if compress == 'gzip':
+            self.compressor = zlib.compressobj(6, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+        elif compress == 'zstd':
+            self.compressor = zstandard.ZstdCompressor().compressobj()
+        else:
+            self.compressor = None
+        # bytes written, before compression
+        self.size = 0
+        self.statements = 0
+
+    def write(self, data):
+        self.size += len(data)
+        self.file.write(self.compressor.compress(data) if self.compressor is not None else data)
+
+    def close(self):
+        """
+        @return int  bytes on disk
+        """
+        if self.compressor is not None:
+            self.file.write(self.compressor.flush())
+        self.file.close()
+        return os.path.getsize(self.path)
+
+
+class Applier(threading.Thread):
+    # the session settings Writer.HEADER makes for a replay of the output document
+    SESSION = [
+        "SET SESSION SQL_MODE='NO_AUTO_VALUE_ON_ZERO'",
+        "SET SESSION UNIQUE_CHECKS=0",
+        "SET SESSION FOREIGN_KEY_CHECKS=0",
+        "SET SESSION SQL_NOTES=0",
+    ]
+
+    def __init__(self, pool, queue, logger, size=1000, stats=None, state=None):
+        """
+        Run the statements of each table put on queue on the target, until a None arrives.
+        @param pool  ConnectionPool  of the target
+        @param size  int             statements per transaction
+        @param stats Stats           where to add the time spent on each table
+        @param state State           where to record the statements committed of each table, so a rerun resuming
+                                     the run does not apply them again
+        """
+        self.pool = pool
+        self.queue = queue
+        self.logger = logger
+        self.size = size
+        self.stats = stats or Stats()
+        self.state = state
+        self.failed = []
+        threading.Thread.__init__(self)
+
+    def apply(self, connection, name, sql):
+        """
+        @param sql list  statements of table name, in the order Writer wrote them
+        """
+        cursor = connection.cursor()
+        # the connection goes back to the pool the workers take theirs from, as it came out of it
+        cursor.execute('SELECT @@SESSION.AUTOCOMMIT, @@SESSION.SQL_MODE, @@SESSION.UNIQUE_CHECKS, '
+                       '@@SESSION.FOREIGN_KEY_CHECKS, @@SESSION.SQL_NOTES')
+        session = cursor.fetchall()[0]
+        for statement in self.SESSION:
+            cursor.execute(statement)
+        connection.autocommit(False)
+        applied = self.state.applied(name) if self.state is not None else 0
+        if applied:
+            self.logger.info('Skipping %d statements of table %s applied by an earlier run', applied, name)
+        for i in xrange(applied, len(sql), self.size):
+            for statement in sql[i:i + self.size]:
+                cursor.execute(statement)
+            connection.commit()
+            if self.state is not None:
+                self.state.record(name, min(i + self.size, len(sql)))
+        cursor.execute('SET SESSION SQL_MODE=%s, UNIQUE_CHECKS=%s, FOREIGN_KEY_CHECKS=%s, SQL_NOTES=%s', session[1:])
+        connection.autocommit(bool(session[0]))
+        cursor.close()
+        self.logger.debug('Applied %d statements to table %s', len(sql) - applied, name)
+
+    def run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            (name, sql) = item
+            connection = self.pool.acquire()
+            begin = time.time()
+            try:
+                self.apply(connection, name, sql)
+                self.stats.add(name, {'apply': {'seconds': time.time() - begin}})
+            except MySQLdb.Error, err:
+                self.logger.error('Failed to apply the changes of table %s: %s', name, err)
+                self.failed.append(name)
+                # the rest of the transaction is rolled back with the connection, and its session settings go too
+                self.pool.discard(connection)
+                continue
+            self.pool.release(connection)
+
+
+class Stats(object):
+    def __init__(self, progress=False):
+        """
+        Wall time, rows and bytes read and rows changed of a run, per phase and per table.
+        @param progress bool  keep a line with the progress and ETA of the run on stderr
+        """
+        self.progress = progress
+        self.begin = self.start = time.time()
+        self.phases = {}
+        self.tables = {}
+        # size of each (name, part) unit, weighting the ETA
+        self.sizes = {}
+        # tables differing and rows changed by target
+        self.targets = {}
+        (self.total, self.done, self.units, self.planned) = (0, 0, 0, 0)
+        self.lock = threading.Lock()
+
+    def phase(self, name, begin):
+        """
+        @return float  now, to begin the next phase with
+        """
+        now = time.time()
+        self.phases[name] = self.phases.get(name, 0) + now - begin
+        return now
+
+    def plan(self, units, targets=(None,)):
+        """
+        @param targets list  label of each target, every unit being compared against all of them
+        """
+        for (size, source, tables, part) in units:
+            # tables without any data length still count for something
+            self.sizes[unit_name(source, tables), part] = max(size, 1)
+        self.total = sum(self.sizes.values()) * len(targets)
+        self.planned = len(self.sizes) * len(targets)
+        self.targets = dict([(target, {'tables': [], 'insert': 0, 'update': 0, 'delete': 0})
+                             for target in targets if target is not None])
+        self.begin = time.time()
+
+    def add(self, name, metrics):
+        with self.lock:
+            Stats.merge(self.tables.setdefault(name, {}), metrics)
+
+    def finished(self, name, part, metrics, target=None):
+        """
+        Add the metrics a worker reported along with a finished unit, and move the progress on.
+        """
+        with self.lock:
+            Stats.merge(self.tables.setdefault(name, {}), metrics)
+            if target in self.targets:
+                for kind in ('insert', 'update', 'delete'):
+                    self.targets[target][kind] += metrics.get(kind, 0)
+            self.done += self.sizes.get((name, part), 0)
+            self.units += 1
+            self.show()
+
+    def diverged(self, target, name):
+        with self.lock:
+            if target in self.targets:
+                self.targets[target]['tables'].append(name)
+
+    def divergence(self, target):
+        changes = self.targets.get(target)
+        if not changes or not changes['tables']:
+            return 'no difference'
+        return '%d tables differ, %d rows to insert, %d to update and %d to delete: %s' % (
+            len(changes['tables']), changes['insert'], changes['update'], changes['delete'],
+            ', '.join(sorted(changes['tables'])))
+
+    @staticmethod
+    def merge(into, metrics):
+        for key, value in metrics.items():
+            if isinstance(value, dict):
+                Stats.merge(into.setdefault(key, {}), value)
+            else:
+                into[key] = into.get(key, 0) + value
+        return into
+
+    @staticmethod
+    def clock(seconds):
+        return '%d:%02d:%02d' % (seconds / 3600, seconds / 60 % 60, seconds % 60)
+
+    def show(self):
+        if not self.progress:
+            return
+        elapsed = time.time() - self.begin
+        left = elapsed * max(self.total - self.done, 0) / self.done if self.done else 0
+        sys.stderr.write('\r%d/%d units, %5.1f%% of data, %s elapsed, ETA %s ' % (
+            self.units, self.planned, 100.0 * self.done / (self.total or 1), self.clock(elapsed), self.clock(left)))
+        sys.stderr.flush()
+
+    def finish(self):
+        if self.progress and self.units:
+            sys.stderr.write('\n')
+
+    @staticmethod
+    def interval(rows, mismatches, z=1.96):
+        """
+        Wilson score interval of the share of mismatched rows, 95% by default. The sampled rows come in ranges rather
+        than one by one, so it is on the narrow side when mismatches cluster.
+        @return tuple  (rate, (lower, upper))
+        """
+        if not rows:
+            return 0.0, (0.0, 1.0)
+        rate = float(mismatches) / rows
+        center = (rate + z * z / (2 * rows)) / (1 + z * z / rows)
+        spread = z * ((rate * (1 - rate) / rows + z * z / (4 * rows * rows)) ** 0.5) / (1 + z * z / rows)
+        return rate, (max(center - spread, 0.0), min(center + spread, 1.0))
+
+    @staticmethod
+    def estimate(rows, mismatches):
+        (rate, (lower, upper)) = Stats.interval(rows, mismatches)
+        return '%d of %d sampled rows differ, %.4f%% (95%% interval %.4f%% - %.4f%%)' % (
+            mismatches, rows, rate * 100, lower * 100, upper * 100)
+
+    def report(self, path):
+        tables = {}
+        for name, metrics in self.tables.items():
+            tables[name] = dict(metrics)
+            diff = metrics.get('diff', {}).get('seconds')
+            if diff:
+                rows = sum([metrics.get(side, {}).get('rows', 0) for side in ('source', 'target')])
+                tables[name]['rows_per_second'] = rows / diff
+            if 'sample' in metrics:
+                (tables[name]['mismatch_rate'], tables[name]['mismatch_bounds']) = \
+                    Stats.interval(**metrics['sample'])
+        with open(path, 'w') as f:
+            json.dump({
+                'version': __version__,
+                'seconds': time.time() - self.start,
+                'phases': self.phases,
+                'total': reduce(Stats.merge, self.tables.values(), {}),
+                'tables': tables,
+                'targets': self.targets,
+            }, f, indent=2, sort_keys=True)
+
+
+class State(object):
+    def __init__(self, path, fingerprint, logger):
+        """
+        A directory recording the work units of a run and the statements of each finished one.
+        @param path        str
+        @param fingerprint str  Comparer.fingerprint of the run
+        """
+        self.path = path
+        self.fingerprint = fingerprint
+        self.logger = logger
+        # units some chunks of which are saved, but not the last one yet
+        self.partial = set()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def plan(self, units, source, target):
+        """
+        Keep the work units of the first run, so a rerun splits tables the same way even if row estimates moved.
+        Only runs against a single target are resumable.
+        """
+        path = os.path.join(self.path, 'plan')
+        if not os.path.exists(path):
+            self.write(path, {
+                'fingerprint': self.fingerprint,
+                'units': [(size, s.name if s is not None else None, t.name if t is not None else None, part)
+                          for (size, s, (t,), part) in units],
+            })
+            return units
+        with open(path, 'rb') as f:
+            plan = cPickle.load(f)
+        if plan['fingerprint'] != self.fingerprint:
+            raise Exception('%s holds the state of a run with other arguments' % self.path)
+        units = []
+        for (size, s, t, part) in plan['units']:
+            if s is not None and s not in source.tables or t is not None and t not in target.tables:
+                raise Exception('Table %s is gone since the run recorded in %s' % (s or t, self.path))
+            units.append((size, source.tables[s] if s is not None else None,
+                          [target.tables[t] if t is not None else None], part))
+        self.logger.info('Resuming the run recorded in %s', self.path)
+        return units
+
+    def segment(self, name, part):
+        return os.path.join(self.path, urllib.quote(name, '') + ('.%d' % part[0] if part is not None else ''))
+
+    def done(self, name, part):
+        return os.path.exists(self.segment(name, part))
+
+    def load(self, name, part):
+        """
+        @return list  statements of each chunk the unit was written in
+        """
+        chunks = []
+        with open(self.segment(name, part), 'rb') as f:
+            while True:
+                try:
+                    chunks.append(cPickle.load(f))
+                except EOFError:
+                    break
+        return chunks
+
+    def save(self, name, part, statements, last=True):
+        """
+        Add a chunk of the statements of a unit to its segment, which only takes its name once the last one is in.
+        """
+        path = self.segment(name, part)
+        if os.path.exists(path):
+            return
+        # what a run cut short left of the unit is started over
+        with open(path + '.tmp', 'ab' if (name, part) in self.partial else 'wb') as f:
+            cPickle.dump(statements, f, cPickle.HIGHEST_PROTOCOL)
+        self.partial.add((name, part))
+        if last:
+            self.partial.discard((name, part))
+            os.rename(path + '.tmp', path)
+
+    def applied(self, name):
+        """
+        @return int  statements of table name already committed on the target
+        """
+        path = os.path.join(self.path, urllib.quote(name, '') + '@applied')
+        if not os.path.exists(path):
+            return 0
+        with open(path, 'rb') as f:
+            return cPickle.load(f)
+
+    def record(self, name, count):
+        # @ is quoted in table names, so this never clashes with a segment
+        self.write(os.path.join(self.path, urllib.quote(name, '') + '@applied'), count)
+
+    @staticmethod
+    def write(path, data):
+        # a half written file must never look like a finished one
+        with open(path + '.tmp', 'wb') as f:
+            cPickle.dump(data, f, cPickle.HIGHEST_PROTOCOL)
+        os.rename(path + '.tmp', path)
+
+
+class Watermarks(object):
+    def __init__(self, path, pair):
+        """
+        A local file remembering the highest watermark value compared of each table, per source and target.
+        @param path str
+        @param pair str  telling the source and target apart from others sharing the file
+        """
+        self.path = path
+        self.pair = pair
+        self.marks = self.load()
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path, 'rb') as f:
+            return cPickle.load(f)
+
+    def get(self, name):
+        return self.marks.get(self.pair, {}).get(name)
+
+    def save(self, marks):
+        # read again, the other targets of a run save theirs to the same file
+        self.marks = self.load()
+        self.marks.setdefault(self.pair, {}).update(marks)
+        State.write(self.path, self.marks)
 
 
 class Dbffer(threading.Thread):
-    def __init__(self, source, target, queue, buf, lock, default_character_set='utf8', blacklist=None, whitelist=None,
-                 no_data=False, log_error=None):
+    MODES = ('row', 'checksum', 'hash', 'spill', 'sample')
+    # mismatched checksum chunks are bisected until they hold no more rows than this
+    BISECT_SIZE = 500
+    # rows fetched per round trip from unbuffered cursors
+    BATCH_SIZE = 1000
+    # batches read ahead of the merge join on each side
+    PREFETCH = 2
+    # rows of a batch measured to tell how much memory the batch takes, see footprint
+    SAMPLE_SIZE = 16
+    # bytes a dict spends on each entry besides the objects of the entry, at the fill it grows at
+    ENTRY_OVERHEAD = 64
+
+    def __init__(self, source, target, queue, output, default_character_set='utf8', blacklist=None, whitelist=None,
+                 no_data=False, log_error=None, mode='row', chunk_size=10000, max_allowed_packet=16777216,
+                 max_memory=268435456, precheck=False, watermarks=None, ignore_columns=None, digest_columns=None,
+                 where=None, samples=20, sample_size=1000, escalate=None):
+        """
+        @param watermarks     dict  (column, value) by table name, to only compare rows whose column is not below value
+        @param ignore_columns list  (table, column) not to compare, table None for every table
+        @param digest_columns list  (table, column, function) to compare as function of the column on the server
+        @param where          dict  condition by table name restricting the rows compared
+        @param samples        int   primary key ranges to compare per table in sample mode
+        @param sample_size    int   rows per sampled range
+        @param escalate       float mismatch percentage past which sample mode compares the whole table
+        """
         self.source = source
         self.target = target
         self.queue = queue
@@ -161,6 +1155,18 @@ class Dbffer(threading.Thread):
         self.blacklist = blacklist
         self.no_data = no_data
         self.log_error = log_error
+        self.mode = mode
+        self.chunk_size = chunk_size
+        self.max_allowed_packet = max_allowed_packet
+        self.max_memory = max_memory
+        self.precheck = precheck
+        self.watermarks = watermarks or {}
+        self.ignore_columns = ignore_columns or []
+        self.digest_columns = digest_columns or []
+        self.where = where or {}
+        self.samples = samples
+        self.sample_size = sample_size
+        self.escalate = escalate
         self.update = []
         self.delete = []
         self.insert = []
@@ -168,39 +1174,84 @@ class Dbffer(threading.Thread):
         self.drop = []
         self.create = []
         self.alter = []
-        self.buf = buf
-        self.lock = lock
+        self.output = output
+        # work left to a Fanout while it has this Dbffer compare a unit, see Dbffer.defer
+        self.shared = None
+        # whether statements of the unit being compared were handed to the writer already, see Dbffer.stream
+        self.streamed = False
+        # what compare measured of the unit being compared, by phase
+        self.metrics = {}
+        # names of the tables failing to compare
+        self.failed = []
         threading.Thread.__init__(self)
 
     def dump(self, table, cursor=None):
         if table.rows > 0:
-            if cursor is None:
-                cursor = table.db.connection.cursor(SSCursor)
             fields = [column.field for column in table.columns]
-            cursor.execute('SELECT * FROM `%s`' % table.name)
-            rows = ','.join([str(Row(row, table, fields)) for row in cursor.fetchall()])
-            self.insert.append('INSERT INTO `%s` VALUES %s' % (table.name, rows))
+            layout = table.layout(fields)
+            insert = self.batcher('insert', 'INSERT INTO `%s` VALUES ' % table.name)
+            if isinstance(self.source, Snapshot):
+                (seconds, batches) = (0, self.source.batches(table, fields))
+            else:
+                if cursor is None:
+                    cursor = self.source.connection.cursor(SSCursor)
+                begin = time.time()
+                cursor.execute('SELECT * FROM `%s`' % table.name)
+                seconds = time.time() - begin
+                batches = iter(lambda: list(cursor.fetchmany(self.BATCH_SIZE)), [])
+            (count, size) = (0, 0)
+            while True:
+                begin = time.time()
+                rows = next(batches, None)
+                seconds += time.time() - begin
+                if not rows:
+                    break
+                (count, size) = (count + len(rows), size + self.volume(rows))
+                for row in rows:
+                    insert.add(layout.literal(row))
+            insert.flush()
+            self.measure('source', seconds, count, size)
         return table.rows
 
-    def compare(self, source, target):
+    def compare(self, source, target, part=None):
+        """
+        @param part tuple  (index, count, lower, upper) to only compare one primary key range of a split table
+        """
+        begin = time.time()
+        if not self.diff(source, target, part):
+            return None
+        self.measure('diff', time.time() - begin)
+        return self.result(source if source is not None else target, part)
+
+    def diff(self, source, target, part=None):
+        """
+        Build the statements of a unit, see Dbffer.compare.
+        @return bool  False when the unit is not to be compared
+        """
         (
             self.update, self.delete, self.insert,
             self.truncate, self.drop, self.create, self.alter
         ) = [], [], [], [], [], [], []
+        (self.batchers, self.metrics) = ([], {})
+        (self.unit, self.streamed) = (((source or target).name, part), False)
         no_data = self.no_data
         if self.whitelist is not None:
             if source and source.name not in self.whitelist or target and target.name not in self.whitelist:
-                return
+                return False
         if self.blacklist and not no_data:
             if source and source.name in self.blacklist or target and target.name in self.blacklist:
                 no_data = True
         if source is None:
             self.drop.append('DROP TABLE `%s`' % target.name)
         elif target is None:
-            cursor = self.source.connection.cursor(SSCursor)
-            cursor.execute('SHOW CREATE TABLE `%s`;' % source.name)
-            self.create.append('%s' % str(cursor.fetchall()[0][1]).replace('\n', ''))
-            if not no_data:
+            if isinstance(self.source, Snapshot):
+                (cursor, create) = (None, self.source.create(source.name))
+            else:
+                cursor = self.source.connection.cursor(SSCursor)
+                cursor.execute('SHOW CREATE TABLE `%s`;' % source.name)
+                create = str(cursor.fetchall()[0][1])
+            self.create.append('%s' % create.replace('\n', ''))
+            if not no_data and not self.defer('dump', source):
                 self.dump(source, cursor)
         else:
             do_not_compare = False
@@ -235,129 +1286,1064 @@ class Dbffer(threading.Thread):
                     pos = 'AFTER `%s`' % columns_in_source[i - 1].field if i > 0 else 'FIRST'
                     self.alter.append('MODIFY COLUMN `%s` %s %s' % (column.field, column, pos))
 
-            for name in [name for name in target.indexes if name not in source.indexes]:
-                if name == 'PRIMARY':
-                    self.alter.append('DROP PRIMARY KEY')
-                    do_not_compare = True
-                else:
-                    self.alter.append('DROP INDEX `%s`' % name)
-                del target.indexes[name]
-            for name in source.indexes:
-                if name in target.indexes and source.indexes[name] != target.indexes[name]:
-                    if name == 'PRIMARY':
-                        do_not_compare = True
-                        self.alter.append('DROP PRIMARY KEY')
-                    else:
-                        self.alter.append('DROP INDEX `%s`' % name)
-                    del target.indexes[name]
-                if name not in target.indexes:
-                    definition = ['ADD']
-                    if source.indexes[name][0].key_name == 'PRIMARY':
-                        definition.append('PRIMARY KEY (`%s`)' %
-                                          '`, `'.join([index.column_name for index in source.indexes[name]]))
-                        do_not_compare = True
-                    elif not source.indexes[name][0].non_unique:
-                        definition.append('UNIQUE KEY `%s` USING %s' % (name, source.indexes[name][0].index_type))
-                        definition.append('(`%s`)' % '`, `'.join([index.column_name for index in source.indexes[name]]))
-                    else:
-                        definition.append('INDEX `%s` USING %s' % (name, source.indexes[name][0].index_type))
-                        definition.append('(`%s`)' % '`, `'.join([index.column_name for index in source.indexes[name]]))
-                    if source.indexes[name][0].index_comment != '':
-                        definition.append("COMMENT '%s'" % source.indexes[name][0].index_comment)
-                    self.alter.append(' '.join(definition))
+            indexes_in_target = dict(target.indexes)
+            for name in [name for name in indexes_in_target if name not in source.indexes]:
+                if name == 'PRIMARY':
+                    self.alter.append('DROP PRIMARY KEY')
+                    do_not_compare = True
+                else:
+                    self.alter.append('DROP INDEX `%s`' % name)
+                del indexes_in_target[name]
+            for name in source.indexes:
+                if name in indexes_in_target and source.indexes[name] != indexes_in_target[name]:
+                    if name == 'PRIMARY':
+                        do_not_compare = True
+                        self.alter.append('DROP PRIMARY KEY')
+                    else:
+                        self.alter.append('DROP INDEX `%s`' % name)
+                    del indexes_in_target[name]
+                if name not in indexes_in_target:
+                    definition = ['ADD']
+                    if source.indexes[name][0].key_name == 'PRIMARY':
+                        definition.append('PRIMARY KEY (`%s`)' %
+                                          '`, `'.join([index.column_name for index in source.indexes[name]]))
+                        do_not_compare = True
+                    elif not source.indexes[name][0].non_unique:
+                        definition.append('UNIQUE KEY `%s` USING %s' % (name, source.indexes[name][0].index_type))
+                        definition.append('(`%s`)' % '`, `'.join([index.column_name for index in source.indexes[name]]))
+                    else:
+                        definition.append('INDEX `%s` USING %s' % (name, source.indexes[name][0].index_type))
+                        definition.append('(`%s`)' % '`, `'.join([index.column_name for index in source.indexes[name]]))
+                    if source.indexes[name][0].index_comment != '':
+                        definition.append("COMMENT '%s'" % source.indexes[name][0].index_comment)
+                    self.alter.append(' '.join(definition))
+
+            if source.engine != target.engine:
+                self.alter.append('ENGINE=%s' % source.engine)
+            if source.comment != target.comment:
+                self.alter.append("COMMENT='%s'" % source.comment)
+
+            if part is not None and part[0] > 0:
+                # the first part of a split table reports the schema changes
+                self.alter = []
+            if not no_data:
+                if do_not_compare:
+                    if part is None or part[0] == 0:
+                        self.truncate.append('TRUNCATE TABLE `%s`' % source.name)
+                        if not self.defer('dump', source):
+                            self.dump(source)
+                else:
+                    if not source.pk_fields:
+                        (source, target) = self.keyed(source, target)
+                    fields_in_source = [column.field for column in source.columns]
+                    fields_in_target = [column.field for column in target.columns]
+                    if fields_in_target != fields_in_source:
+                        fields_in_target = sorted(
+                            set([column.field for column in target.columns]) & set(fields_in_source))
+                        fields_in_source = sorted(fields_in_source)
+                    ignored = self.ignored(source)
+                    fields_in_source = [field for field in fields_in_source if field not in ignored]
+                    fields_in_target = [field for field in fields_in_target if field not in ignored]
+                    (lower, upper) = part[2:] if part is not None else (None, None)
+                    where = self.where.get(source.name)
+                    condition = ' AND '.join(filter(None, [source.key_range(lower, upper), where]))
+                    (column, mark) = self.watermarks.get(source.name, (None, None))
+                    if not source.pk_fields and self.mode == 'sample':
+                        self.source.logger.warn('Table %s has no key to sample ranges of, skipped', source.name)
+                    elif not source.pk_fields:
+                        self.compare_multiset(source, target, fields_in_source, fields_in_target, where)
+                    elif isinstance(self.source, Snapshot) or isinstance(self.target, Snapshot):
+                        self.compare_offline(source, target, fields_in_source, fields_in_target, lower, upper)
+                    elif mark is not None and source.pk_fields and fields_in_source == fields_in_target:
+                        self.compare_incremental(source, target, fields_in_source, column, mark, condition)
+                    elif self.precheck and fields_in_source == fields_in_target and \
+                            self.identical(source, target, fields_in_source, condition):
+                        self.source.logger.debug('Rows of %s are identical, skipped', source.name)
+                    elif self.mode == 'checksum' and source.pk_fields and fields_in_source == fields_in_target:
+                        self.compare_checksum(source, target, fields_in_source, lower, upper, where)
+                    elif self.mode == 'hash' and source.pk_fields and fields_in_source == fields_in_target:
+                        self.compare_hash(source, target, fields_in_source, condition)
+                    elif self.mode == 'sample' and source.pk_fields:
+                        self.compare_sample(source, target, fields_in_source, fields_in_target, part, where)
+                    elif self.defer('spill' if self.mode == 'spill' else 'rows',
+                                    source, target, fields_in_source, fields_in_target, condition):
+                        self.source.logger.debug('Rows of %s left to compare against every target at once', source.name)
+                    elif self.mode == 'spill':
+                        self.compare_spill(source, target, fields_in_source, fields_in_target, condition)
+                    else:
+                        self.compare_rows(source, target, fields_in_source, fields_in_target, condition)
+        return True
+
+    def keyed(self, source, target):
+        """
+        Both sides of a table without a primary key taking the first non null UNIQUE key they share for one, so the
+        table is compared like any other; left as they are when they share none, or when a side is a Snapshot, which
+        does not keep the rows in the order of such a key.
+        """
+        if isinstance(self.source, Snapshot) or isinstance(self.target, Snapshot):
+            return source, target
+        keys = target.unique_keys()
+        for key in source.unique_keys():
+            if key in keys:
+                self.source.logger.debug('Comparing %s by its unique key (%s)', source.name, ', '.join(key))
+                return source.keyed(key), target.keyed(key)
+        return source, target
+
+    def result(self, table, part):
+        """
+        @return tuple  (name, part, statements, metrics) of the unit diff built
+        """
+        for (kind, batcher) in self.batchers:
+            self.metrics[kind] = self.metrics.get(kind, 0) + batcher.count
+        self.metrics['update'] = self.metrics.get('update', 0) + len(self.update)
+        return table.name, part, [
+            self.create, self.drop, self.truncate, self.alter, self.delete, self.update, self.insert
+        ], self.metrics
+
+    def defer(self, *work):
+        """
+        Leave work reading the whole source table to the Fanout comparing this unit, which does it once for every
+        target, if there is one.
+        @param work tuple  ('dump', table) or ('rows' or 'spill', source, target, fields_in_source,
+                           fields_in_target, condition)
+        @return bool  whether it was left
+        """
+        if self.shared is None:
+            return False
+        self.shared.append(work)
+        return True
+
+    def batcher(self, kind, prefix, suffix=''):
+        """
+        A Batcher appending to the statements of kind, whose values are counted in the metrics of the table.
+        """
+        batcher = Batcher(getattr(self, kind), prefix, suffix, size=self.max_allowed_packet, flushed=self.stream)
+        self.batchers.append((kind, batcher))
+        return batcher
+
+    def stream(self):
+        """
+        Hand the statements built so far of the unit to the writer as a chunk, so only about a batch of them is
+        held at once however big the table. Only a Dbffer with an output of its own does; those of a Fanout or of
+        the process backend hand over whole units.
+        """
+        statements = [self.create, self.drop, self.truncate, self.alter, self.delete, self.update, self.insert]
+        if self.output is None or not any(statements):
+            return
+        self.metrics['update'] = self.metrics.get('update', 0) + len(self.update)
+        self.output.put(self.unit + ([list(buf) for buf in statements], None))
+        # emptied in place, batchers keep appending to these very lists
+        for buf in statements:
+            del buf[:]
+        self.streamed = True
+
+    def measure(self, phase, seconds, rows=0, size=0):
+        metrics = self.metrics.setdefault(phase, {'seconds': 0, 'rows': 0, 'bytes': 0})
+        metrics['seconds'] += seconds
+        metrics['rows'] += rows
+        metrics['bytes'] += size
+
+    def side(self, db):
+        return 'source' if db is self.source else 'target'
+
+    @staticmethod
+    def volume(rows):
+        """
+        @return int  about how many bytes the values of rows take
+        """
+        return sum([len(value) if isinstance(value, basestring) else 8 for row in rows for value in row])
+
+    @classmethod
+    def footprint(cls, entries):
+        """
+        Measure a sample of entries as CPython holds them, with the tuples, lists and values they hold.
+        @return int  about how many bytes all of entries take in memory
+        """
+        if not entries:
+            return 0
+        sample = entries[::max(1, len(entries) // cls.SAMPLE_SIZE)]
+        (size, seen, pending) = (0, set(), [sample])
+        while pending:
+            item = pending.pop()
+            if id(item) in seen:
+                continue
+            seen.add(id(item))
+            size += sys.getsizeof(item)
+            if isinstance(item, (tuple, list)):
+                pending.extend(item)
+        return size * len(entries) // len(sample)
+
+    def ignored(self, table):
+        return set([column for (name, column) in self.ignore_columns if name in (None, table.name)])
+
+    def digested(self, table, fields_in_source, fields_in_target):
+        """
+        @return dict  SQL function computing what to compare instead of the value, by field of both sides
+        """
+        digests = {}
+        # the columns named for this very table win over those given for every table
+        for (name, column, function) in sorted(self.digest_columns, key=lambda item: item[0] is not None):
+            if name in (None, table.name) and column in fields_in_source and column in fields_in_target:
+                digests[column] = function
+        return digests
+
+    @staticmethod
+    def select(fields, digests):
+        if not digests:
+            return None
+        return ', '.join([('%s(`%s`)' % (digests[field], field)) if field in digests else '`%s`' % field
+                          for field in fields])
+
+    def rows(self, db, table, fields, condition=None, columns=None):
+        """
+        @param columns str  select list to use instead of fields, which then only name the selected values
+        """
+        batches = self.prefetch(db, self.query(table, fields, condition, columns))
+        layout = table.layout(fields)
+        return (Row(row, layout) for rows in batches for row in rows)
+
+    def scan(self, db, table, fields, lower=None, upper=None, keys=None, digest=False, where=None):
+        """
+        Rows of table on db, a server or a Snapshot, in primary key order: those between lower and upper, as in
+        Table.key_range, or those of keys only.
+        @param digest bool  read the primary key and the digest of the whole row, which fields then name
+        @param where  str   condition the rows read from a server also meet
+        """
+        layout = table.layout(fields)
+        if isinstance(db, Snapshot):
+            return (Row(row, layout) for rows in self.timed(db, db.batches(table, fields, lower, upper, keys))
+                    for row in rows)
+        columns = None
+        if digest:
+            columns = '`%s`, %s' % ('`,`'.join(table.pk_fields),
+                                    Table.digest_expression([column.field for column in table.columns]))
+        condition = table.key_in(keys) if keys is not None else table.key_range(lower, upper)
+        return self.rows(db, table, fields, ' AND '.join(filter(None, [condition, where])), columns)
+
+    def timed(self, db, batches):
+        """
+        Pass batches on, measuring how long reading them takes.
+        """
+        (seconds, count, size) = (0, 0, 0)
+        while True:
+            begin = time.time()
+            rows = next(batches, None)
+            seconds += time.time() - begin
+            if rows is None:
+                break
+            (count, size) = (count + len(rows), size + self.volume(rows))
+            yield rows
+        self.measure(self.side(db), seconds, count, size)
+
+    @staticmethod
+    def query(table, fields, condition=None, columns=None):
+        query = ['SELECT %s FROM `%s`' % (columns or '`%s`' % '`,`'.join(fields), table.name)]
+        if condition:
+            query.append('WHERE %s' % condition)
+        if table.pk_fields:
+            query.append('ORDER BY %s' % table.key_order)
+        return ' '.join(query)
+
+    def prefetch(self, db, query):
+        """
+        Run query on db and fetch its result from another thread, started right away, so waiting for one server
+        overlaps with waiting for the other.
+        @return generator  of row batches
+        """
+        batches = Queue.Queue(self.PREFETCH)
+
+        def fetch():
+            try:
+                cursor = db.connection.cursor(SSCursor)
+                begin = time.time()
+                cursor.execute(query)
+                (seconds, count, size) = (time.time() - begin, 0, 0)
+                while True:
+                    begin = time.time()
+                    rows = cursor.fetchmany(self.BATCH_SIZE)
+                    seconds += time.time() - begin
+                    if not rows:
+                        break
+                    (count, size) = (count + len(rows), size + self.volume(rows))
+                    batches.put(rows)
+                cursor.close()
+                # before the end of the rows is told, so the metrics are complete once they are read
+                self.measure(self.side(db), seconds, count, size)
+                batches.put(None)
+            except Exception, err:
+                batches.put(err)
+        thread = threading.Thread(target=fetch)
+        thread.daemon = True
+        thread.start()
+        return self.drain(batches)
+
+    def tee(self, batches, count):
+        """
+        Read batches from another thread and hand each of them to count readers, the fastest of which waits once it is
+        PREFETCH batches ahead of the slowest.
+        @return list  count generators of the batches
+        """
+        queues = [Queue.Queue(self.PREFETCH) for i in xrange(count)]
+
+        def pump():
+            end = None
+            try:
+                for batch in batches:
+                    for queue in queues:
+                        queue.put(batch)
+            except Exception, err:
+                end = err
+            for queue in queues:
+                queue.put(end)
+        thread = threading.Thread(target=pump)
+        thread.daemon = True
+        thread.start()
+        return [self.drain(queue) for queue in queues]
+
+    @staticmethod
+    def drain(batches):
+        while True:
+            rows = batches.get()
+            if rows is None:
+                break
+            if isinstance(rows, Exception):
+                raise rows
+            yield rows
+
+    def spill(self, db, table, fields, condition=None, columns=None):
+        """
+        Read table in whatever order the server returns it and yield its rows sorted by primary key, sorting runs of
+        at most half of max_memory bytes in memory and merging them back from temporary files.
+        @param columns str  select list to use instead of fields, which then only name the selected values
+        """
+        cursor = db.connection.cursor(SSCursor)
+        query = ['SELECT %s FROM `%s`' % (columns or '`%s`' % '`,`'.join(fields), table.name)]
+        if condition:
+            query.append('WHERE %s' % condition)
+        begin = time.time()
+        cursor.execute(' '.join(query))
+        layout = table.layout(fields)
+        (buf, size, runs) = [], 0, []
+        (seconds, count, read) = (time.time() - begin, 0, 0)
+        while True:
+            begin = time.time()
+            rows = cursor.fetchmany(self.BATCH_SIZE)
+            seconds += time.time() - begin
+            if not rows:
+                break
+            entries = [(layout.key(row), row) for row in rows]
+            buf.extend(entries)
+            (count, read) = (count + len(rows), read + self.volume(rows))
+            size += self.footprint(entries)
+            if size > self.max_memory / 2:
+                self.source.logger.debug('Spilling %d rows of %s to disk', len(buf), table.name)
+                runs.append(self.read_run(self.write_run(buf)))
+                (buf, size) = [], 0
+        cursor.close()
+        self.measure(self.side(db), seconds, count, read)
+        buf.sort()
+        runs.append(iter(buf))
+        for (key, row) in heapq.merge(*runs):
+            yield Row(row, layout)
+
+    def write_run(self, buf):
+        buf.sort()
+        f = tempfile.TemporaryFile()
+        for i in xrange(0, len(buf), self.BATCH_SIZE):
+            cPickle.dump(buf[i:i + self.BATCH_SIZE], f, cPickle.HIGHEST_PROTOCOL)
+        f.seek(0)
+        return f
+
+    def read_run(self, f):
+        while True:
+            try:
+                rows = cPickle.load(f)
+            except EOFError:
+                break
+            for row in rows:
+                yield row
+        f.close()
+
+    def compare_spill(self, source, target, fields_in_source, fields_in_target, condition=None):
+        """
+        Like compare_rows, but sort each side on the client, so neither the server order nor the collation matter.
+        """
+        digests = self.digested(source, fields_in_source, fields_in_target)
+        self.merge(source, target, fields_in_source, fields_in_target,
+                   self.spill(self.source, source, fields_in_source, condition, self.select(fields_in_source, digests)),
+                   self.spill(self.target, target, fields_in_target, condition, self.select(fields_in_target, digests)),
+                   self.deferred(source, fields_in_source, digests))
+
+    def compare_rows(self, source, target, fields_in_source, fields_in_target, condition=None):
+        """
+        Merge join both sides ordered by primary key, so only one batch of each is held in memory.
+        """
+        digests = self.digested(source, fields_in_source, fields_in_target)
+        self.merge(source, target, fields_in_source, fields_in_target,
+                   self.rows(self.source, source, fields_in_source, condition, self.select(fields_in_source, digests)),
+                   self.rows(self.target, target, fields_in_target, condition, self.select(fields_in_target, digests)),
+                   self.deferred(source, fields_in_source, digests))
+
+    @staticmethod
+    def deferred(table, fields, digests):
+        """
+        @return set  fields the row streams only hold digests of, None when they hold every value to write
+        """
+        if not digests and len(fields) == len(table.columns):
+            return None
+        return set(digests)
+
+    def merge(self, source, target, fields_in_source, fields_in_target, rows_in_source, rows_in_target,
+              deferred=None):
+        """
+        Walk two row streams sorted by primary key and build the statements turning the target into the source.
+        @param deferred set  see Dbffer.deferred, if not None the rows to insert, or to update in one of these
+                             fields, are fetched whole from the source once both streams are read
+        """
+        # where each source value sits in a target row
+        positions = [target.layout(fields_in_target).positions.get(field) for field in fields_in_source]
+        encoders = source.layout(fields_in_source).encoders
+        key_encoders = source.layout(source.pk_fields).encoders
+        fields = fields_in_source if deferred is None else [column.field for column in source.columns]
+        insert = self.batcher('insert', 'INSERT INTO `%s` (`%s`) VALUES ' % (target.name, '`,`'.join(fields)))
+        delete = self.batcher('delete', 'DELETE FROM `%s` WHERE %s IN (' % (target.name, source.key_columns), ')')
+        # fields to update by key of the rows fetched afterwards, None for the rows to insert
+        pending = {}
+        row_in_source = next(rows_in_source, None)
+        row_in_target = next(rows_in_target, None)
+        while row_in_source is not None or row_in_target is not None:
+            if row_in_target is None or row_in_source is not None and row_in_source.key < row_in_target.key:
+                if deferred is None:
+                    insert.add(str(row_in_source))
+                else:
+                    pending[row_in_source.key] = None
+                row_in_source = next(rows_in_source, None)
+            elif row_in_source is None or row_in_source.key > row_in_target.key:
+                delete.add(source.key_literal(row_in_target.key))
+                row_in_target = next(rows_in_target, None)
+            else:
+                if row_in_source != row_in_target:
+                    changed = []
+                    for k, v in enumerate(row_in_source.seq):
+                        j = positions[k]
+                        if not Row.same(v, row_in_target.seq[j] if j is not None else None):
+                            changed.append(k)
+                    if deferred and [k for k in changed if fields_in_source[k] in deferred]:
+                        pending[row_in_source.key] = [fields_in_source[k] for k in changed]
+                    elif changed:
+                        self.update.append(self.assignment(target, [
+                            "`%s`=%s" % (fields_in_source[k], encoders[k](row_in_source.seq[k])) for k in changed
+                        ], key_encoders, row_in_target.key))
+                        if len(self.update) == self.BATCH_SIZE:
+                            self.stream()
+                row_in_source = next(rows_in_source, None)
+                row_in_target = next(rows_in_target, None)
+        delete.flush()
+
+        # both connections are free again only once the streams have been read to the end
+        keys = sorted(pending)
+        layout = source.layout(fields)
+        for i in xrange(0, len(keys), self.BATCH_SIZE):
+            for row in self.scan(self.source, source, fields, keys=keys[i:i + self.BATCH_SIZE]):
+                if pending[row.key] is None:
+                    insert.add(str(row))
+                else:
+                    self.update.append(self.assignment(target, [
+                        "`%s`=%s" % (field, layout.encoders[layout.positions[field]](row[field]))
+                        for field in pending[row.key]
+                    ], key_encoders, row.key))
+                    if len(self.update) == self.BATCH_SIZE:
+                        self.stream()
+        insert.flush()
+
+    @staticmethod
+    def assignment(table, values, key_encoders, key):
+        """
+        @param values list  `field`=literal to set in the row of key
+        """
+        condition = ["`%s`=%s" % (field, encode(value))
+                     for field, encode, value in zip(table.pk_fields, key_encoders, key)]
+        return 'UPDATE `%s` SET %s WHERE %s' % (table.name, ', '.join(values), ' AND '.join(condition))
+
+    def compare_multiset(self, source, target, fields_in_source, fields_in_target, where=None):
+        """
+        Compare a table with no key at all as two multisets of rows: count the rows of each side by the digest of
+        their values and turn the surplus of the target into deletes and that of the source into inserts. Rows are
+        first shared out to buckets by digest, spilled to temporary files when both sides would not fit in
+        max_memory, so only the rows of one bucket are counted at a time.
+        """
+        fields = [field for field in fields_in_source if field in fields_in_target]
+        # a column the target lacks gets its default from the ALTER adding it, so the rows of the target are
+        # counted as holding that default, and those of the source holding another value differ from them
+        defaults = dict([(column.field, column.default) for column in source.columns])
+        positions = [fields.index(field) if field in fields else None for field in fields_in_source]
+        (rows_in_source, rows_in_target) = (self.scan(self.source, source, fields_in_source, where=where), None)
+        # the first rows tell how much memory counting a row takes, as a digest keying [count, values in the source,
+        # values in the target], those of the target only when the source has none, not to leave its query waiting
+        head = list(itertools.islice(rows_in_source, self.BATCH_SIZE))
+        rows_in_source = itertools.chain(head, rows_in_source)
+        if not head:
+            rows_in_target = self.scan(self.target, target, fields, where=where)
+            head = list(itertools.islice(rows_in_target, self.BATCH_SIZE))
+            rows_in_target = itertools.chain(head, rows_in_target)
+        sample = [(hashlib.md5(str(i)).digest(), [1, row.seq, None]) for i, row in enumerate(head)]
+        size = (self.footprint(sample) // max(len(sample), 1) + self.ENTRY_OVERHEAD) * sum(
+            [table.rows or 0 for table in (source, target)])
+        buckets = 1 + int(size / (self.max_memory / 2))
+        if buckets > 1:
+            self.source.logger.debug('Counting the rows of %s in %d buckets', source.name, buckets)
+        # both sides are written out the same way, so a value of the same type reads the same on either side
+        layout = source.layout(fields_in_source)
+        rows_in_source = self.partition(rows_in_source, lambda seq: seq, layout.literal, buckets)
+        if rows_in_target is None:
+            rows_in_target = self.scan(self.target, target, fields, where=where)
+        rows_in_target = self.partition(rows_in_target, lambda seq: [
+            seq[i] if i is not None else defaults[field] for field, i in zip(fields_in_source, positions)],
+            layout.literal, buckets)
+        insert = self.batcher('insert', 'INSERT INTO `%s` (`%s`) VALUES ' % (
+            target.name, '`,`'.join(fields_in_source)))
+        encoders = target.layout(fields).encoders
+        deleted = 0
+        for (bucket_in_source, bucket_in_target) in zip(rows_in_source, rows_in_target):
+            # [copies in the source less those in the target, values in the source, values in the target]
+            counts = {}
+            for (digest, seq) in bucket_in_source:
+                if digest in counts:
+                    counts[digest][0] += 1
+                else:
+                    counts[digest] = [1, seq, None]
+            for (digest, seq) in bucket_in_target:
+                if digest in counts:
+                    counts[digest][0] -= 1
+                    counts[digest][2] = seq
+                else:
+                    counts[digest] = [-1, None, seq]
+            for digest in sorted(counts):
+                (count, seq_in_source, seq_in_target) = counts[digest]
+                if count > 0:
+                    for i in xrange(count):
+                        insert.add(layout.literal(seq_in_source))
+                elif count < 0:
+                    # nothing tells the copies apart, so any -count of them do
+                    self.delete.append('DELETE FROM `%s` WHERE %s LIMIT %d' % (target.name, ' AND '.join(
+                        ['`%s` <=> %s' % (field, encode(value))
+                         for field, encode, value in zip(fields, encoders, seq_in_target)]), -count))
+                    deleted -= count
+                    if len(self.delete) == self.BATCH_SIZE:
+                        self.stream()
+        insert.flush()
+        if deleted:
+            self.metrics['delete'] = self.metrics.get('delete', 0) + deleted
+
+    def partition(self, rows, values, literal, buckets):
+        """
+        Share rows out to buckets by the digest of their values.
+        @param values  function  taking the values of a row to compare it by
+        @param literal function  writing those values out, as Layout.literal
+        @return list  of each bucket, an iterable of (digest, row values) pairs
+        """
+        pairs = ((hashlib.md5(literal(values(row.seq))).digest(), row.seq) for row in rows)
+        if buckets == 1:
+            return [pairs]
+        (files, bufs) = ([tempfile.TemporaryFile() for i in xrange(buckets)], [[] for i in xrange(buckets)])
+        for pair in pairs:
+            i = int(binascii.hexlify(pair[0][:4]), 16) % buckets
+            bufs[i].append(pair)
+            if len(bufs[i]) == self.BATCH_SIZE:
+                cPickle.dump(bufs[i], files[i], cPickle.HIGHEST_PROTOCOL)
+                bufs[i] = []
+        for f, buf in zip(files, bufs):
+            if buf:
+                cPickle.dump(buf, f, cPickle.HIGHEST_PROTOCOL)
+            f.seek(0)
+        return [self.read_run(f) for f in files]
+
+    def compare_hash(self, source, target, fields, condition=None):
+        """
+        Merge join primary keys and row digests computed by the servers, then fetch whole rows only for keys that
+        are missing from the target or whose digest differs.
+        """
+        # the digest travels as the last value of each row, after the primary key
+        digest = list(source.pk_fields) + [None]
+        columns = '`%s`, %s' % ('`,`'.join(source.pk_fields), Table.digest_expression(fields))
+        keys = self.differing(source, target, self.rows(self.source, source, digest, condition, columns),
+                              self.rows(self.target, target, digest, condition, columns))
+
+        # both connections are free again only once the digest streams have been read to the end
+        for i in xrange(0, len(keys), self.BATCH_SIZE):
+            self.compare_rows(source, target, fields, fields, source.key_in(keys[i:i + self.BATCH_SIZE]))
+
+    def differing(self, source, target, rows_in_source, rows_in_target, digests=True):
+        """
+        Merge join two streams of primary keys followed by row digests, deleting the rows missing from the source.
+        @param digests bool  whether the rows end in a digest, otherwise they hold the primary key alone
+        @return list  keys of the rows missing from the target or whose digest differs, in order
+        """
+        delete = self.batcher('delete', 'DELETE FROM `%s` WHERE %s IN (' % (target.name, source.key_columns), ')')
+        keys = []
+        row_in_source = next(rows_in_source, None)
+        row_in_target = next(rows_in_target, None)
+        while row_in_source is not None or row_in_target is not None:
+            if row_in_target is None or row_in_source is not None and row_in_source.key < row_in_target.key:
+                keys.append(row_in_source.key)
+                row_in_source = next(rows_in_source, None)
+            elif row_in_source is None or row_in_source.key > row_in_target.key:
+                delete.add(source.key_literal(row_in_target.key))
+                row_in_target = next(rows_in_target, None)
+            else:
+                if digests and row_in_source.seq[-1] != row_in_target.seq[-1]:
+                    keys.append(row_in_source.key)
+                row_in_source = next(rows_in_source, None)
+                row_in_target = next(rows_in_target, None)
+        delete.flush()
+        return keys
+
+    def compare_offline(self, source, target, fields_in_source, fields_in_target, lower=None, upper=None,
+                        keys=None):
+        """
+        Compare when either side is a Snapshot, which runs no SQL: merge join whole rows, or in hash mode merge join
+        row digests first when every snapshot side kept those of each row. Digest columns are compared whole,
+        a snapshot holding the values rather than their digests.
+        """
+        fields = [column.field for column in source.columns]
+        if keys is None and self.mode == 'hash' and fields_in_source == fields_in_target == fields and not [
+                db for (db, table) in ((self.source, source), (self.target, target))
+                if isinstance(db, Snapshot) and not db.digested(table)]:
+            digest = list(source.pk_fields) + [None]
+            keys = self.differing(source, target,
+                                  self.scan(self.source, source, digest, lower, upper, digest=True),
+                                  self.scan(self.target, target, digest, lower, upper, digest=True))
+            for i in xrange(0, len(keys), self.BATCH_SIZE):
+                self.compare_offline(source, target, fields, fields, keys=keys[i:i + self.BATCH_SIZE])
+            return
+        self.merge(source, target, fields_in_source, fields_in_target,
+                   self.scan(self.source, source, fields_in_source, lower, upper, keys),
+                   self.scan(self.target, target, fields_in_target, lower, upper, keys),
+                   self.deferred(source, fields_in_source, {}))
+
+    def compare_incremental(self, source, target, fields, column, mark, condition=None):
+        """
+        Fetch whole rows only for keys the source changed since mark, by its watermark column, or that are missing
+        from either side, found by merge joining the primary keys alone.
+        """
+        key = list(source.pk_fields)
+        keys = set(self.differing(source, target, self.rows(self.source, source, key, condition),
+                                  self.rows(self.target, target, key, condition), digests=False))
+
+        # not only above mark, rows changed within the second mark was read in may share its value
+        changed = ' AND '.join(filter(None, [condition, '`%s` >= %s' % (column, Row.escape(mark))]))
+        keys.update([row.key for row in self.rows(self.source, source, key, changed)])
+        self.source.logger.debug('Comparing %d rows of %s changed since %s', len(keys), source.name, mark)
+        keys = sorted(keys)
+        for i in xrange(0, len(keys), self.BATCH_SIZE):
+            self.compare_rows(source, target, fields, fields, source.key_in(keys[i:i + self.BATCH_SIZE]))
+
+    def identical(self, source, target, fields, condition=None):
+        """
+        Tell whether both sides hold the same rows without fetching any: CHECKSUM TABLE QUICK when both engines keep
+        a live checksum, otherwise the row count and checksum aggregated by the servers.
+        """
+        if not condition:
+            checksums = [self.live_checksum(self.source, source), self.live_checksum(self.target, target)]
+            if None not in checksums:
+                return checksums[0] == checksums[1]
+        return self.checksum(self.source, source, fields, condition) == \
+            self.checksum(self.target, target, fields, condition)
+
+    def live_checksum(self, db, table):
+        cursor = db.connection.cursor(SSCursor)
+        cursor.execute('CHECKSUM TABLE `%s` QUICK' % table.name)
+        (name, checksum) = cursor.fetchall()[0]
+        cursor.close()
+        return checksum
+
+    def checksum(self, db, table, fields, condition=None):
+        cursor = db.connection.cursor(SSCursor)
+        begin = time.time()
+        cursor.execute('SELECT COUNT(*), %s FROM `%s`%s' % (
+            table.checksum_expression(fields), table.name, ' WHERE %s' % condition if condition else ''))
+        (count, checksum) = cursor.fetchall()[0]
+        cursor.close()
+        self.measure(self.side(db), time.time() - begin)
+        return count, checksum
+
+    def chunks(self, table, lower=None, upper=None, where=None):
+        """
+        Walk the primary key of table from lower to upper and yield (lower, upper] ranges holding chunk_size rows
+        each, the last range ending at upper so it also covers rows that only exist on the other side.
+        @param where str  condition the rows counted must also meet
+        """
+        cursor = self.source.connection.cursor(SSCursor)
+        while True:
+            condition = ' AND '.join(filter(None, [table.key_range(lower, upper), where]))
+            cursor.execute('SELECT `%s` FROM `%s`%s ORDER BY `%s` LIMIT 1 OFFSET %d' % (
+                '`,`'.join(table.pk_fields), table.name, ' WHERE %s' % condition if condition else '',
+                '`, `'.join(table.pk_fields), self.chunk_size - 1))
+            rows = cursor.fetchall()
+            if not rows:
+                break
+            yield lower, tuple(rows[0])
+            lower = tuple(rows[0])
+        cursor.close()
+        yield lower, upper
+
+    def bisect(self, db, table, lower, upper, count, where=None):
+        cursor = db.connection.cursor(SSCursor)
+        condition = ' AND '.join(filter(None, [table.key_range(lower, upper), where]))
+        cursor.execute('SELECT `%s` FROM `%s`%s ORDER BY `%s` LIMIT 1 OFFSET %d' % (
+            '`,`'.join(table.pk_fields), table.name, ' WHERE %s' % condition if condition else '',
+            '`, `'.join(table.pk_fields), count / 2 - 1))
+        rows = cursor.fetchall()
+        cursor.close()
+        return tuple(rows[0]) if rows else None
 
-            if source.engine != target.engine:
-                self.alter.append('ENGINE=%s' % source.engine)
-            if source.comment != target.comment:
-                self.alter.append("COMMENT='%s'" % source.comment)
+    def compare_range(self, source, target, fields, lower, upper, where=None):
+        condition = ' AND '.join(filter(None, [source.key_range(lower, upper), where]))
+        checksum_in_source = self.checksum(self.source, source, fields, condition)
+        checksum_in_target = self.checksum(self.target, target, fields, condition)
+        if checksum_in_source == checksum_in_target:
+            return
+        count = max(checksum_in_source[0], checksum_in_target[0])
+        middle = None
+        if count > self.BISECT_SIZE:
+            if checksum_in_source[0] >= checksum_in_target[0]:
+                middle = self.bisect(self.source, source, lower, upper, count, where)
+            else:
+                middle = self.bisect(self.target, target, lower, upper, count, where)
+        if middle is None:
+            self.compare_rows(source, target, fields, fields, condition)
+        else:
+            self.compare_range(source, target, fields, lower, middle, where)
+            self.compare_range(source, target, fields, middle, upper, where)
 
-            if not no_data:
-                if do_not_compare:
-                    self.truncate.append('TRUNCATE TABLE `%s`' % source.name)
-                    self.dump(source)
+    def sample(self, table, lower=None, upper=None, where=None, count=1):
+        """
+        Yield up to count (lower, upper] ranges of sample_size rows, in key order and none overlapping another, each
+        starting at a random key between lower and upper: a random value of the first primary key column if it is
+        an integer, otherwise a random offset among the rows meeting where. Each is sought from the end of the range
+        before it, which a draw falling inside that range starts the next one at, so the server walks the rows only
+        once for all of them.
+        """
+        condition = ' AND '.join(filter(None, [table.key_range(lower, upper), where]))
+        first = table.pk_fields[0]
+        cursor = self.source.connection.cursor(SSCursor)
+        # the order of the primary key index, as chunks and bisect seek in, not to sort what follows each draw
+        query = 'SELECT `%s` FROM `%s` WHERE %s ORDER BY `%s` LIMIT 1' % (
+            '`,`'.join(table.pk_fields), table.name, '%s', '`, `'.join(table.pk_fields))
+        integer = [column for column in table.columns
+                   if column.field == first and re.match(r'(tiny|small|medium|big)?int\b', column.type)]
+        if integer:
+            cursor.execute('SELECT MIN(`%s`), MAX(`%s`) FROM `%s`%s' % (
+                first, first, table.name, ' WHERE %s' % condition if condition else ''))
+            (low, high) = cursor.fetchall()[0]
+            draws = sorted([random.randint(low, high) for i in xrange(count)]) if low is not None else []
+        else:
+            cursor.execute('SELECT COUNT(*) FROM `%s`%s' % (table.name, ' WHERE %s' % condition if condition else ''))
+            total = cursor.fetchall()[0][0]
+            draws = sorted(random.sample(xrange(total), min(count, total)))
+        # end of the range before, and the offset of that key among the rows meeting where
+        (previous, position) = (None, -1)
+        for draw in draws:
+            if previous is not None and (draw <= previous[0] if integer else draw <= position):
+                start = previous
+            else:
+                seek = ' AND '.join(filter(None, [table.key_range(previous or lower, upper), where]))
+                if integer:
+                    cursor.execute(query % ' AND '.join(filter(None, [seek, '`%s` >= %d' % (first, draw)])))
                 else:
-                    fields_in_source = [column.field for column in source.columns]
-                    fields_in_target = [column.field for column in target.columns]
-                    if fields_in_target != fields_in_source:
-                        fields_in_target = sorted(
-                            set([column.field for column in target.columns]) & set(fields_in_source))
-                        fields_in_source = sorted(fields_in_source)
-                    rows_in_source = dict()
+                    cursor.execute((query % (seek or '1')) + ' OFFSET %d' % (draw - position - 1))
+                    position = draw
+                rows = cursor.fetchall()
+                if not rows:
+                    break
+                start = tuple(rows[0])
+            end = self.bisect(self.source, table, start, upper, self.sample_size * 2, where)
+            yield start, end or upper
+            if end is None:
+                break
+            (previous, position) = (end, position + self.sample_size)
+        cursor.close()
+
+    def compare_sample(self, source, target, fields_in_source, fields_in_target, part=None, where=None):
+        """
+        Compare a few random primary key ranges only and count the rows that differ in them, writing no statement
+        unless the share of those passes escalate, which makes it compare the whole table instead.
+        """
+        (lower, upper) = part[2:] if part is not None else (None, None)
+        count = (self.samples + part[1] - 1) / part[1] if part is not None else self.samples
+        # the statements of the sample ranges only count what differs, none of them is to be streamed to the writer
+        (statements, output) = ((self.insert, self.update, self.delete, self.batchers), self.output)
+        (rows, mismatches, sampled) = (0, 0, 0)
+        self.output = None
+        try:
+            for (start, end) in self.sample(source, lower, upper, where, count):
+                sampled += 1
+                (self.insert, self.update, self.delete, self.batchers) = ([], [], [], [])
+                read = self.metrics.get('source', {}).get('rows', 0)
+                self.compare_rows(source, target, fields_in_source, fields_in_target,
+                                  ' AND '.join(filter(None, [source.key_range(start, end), where])))
+                deleted = sum([batcher.count for (kind, batcher) in self.batchers if kind == 'delete'])
+                # every key of either side in the range
+                rows += self.metrics['source']['rows'] - read + deleted
+                mismatches += sum([batcher.count for (kind, batcher) in self.batchers]) + len(self.update)
+        finally:
+            (self.insert, self.update, self.delete, self.batchers) = statements
+            self.output = output
+        if sampled < count:
+            self.source.logger.info('%s: compared %d of %d sample ranges, too few rows to draw more from',
+                                    source.name, sampled, count)
+        self.metrics['sample'] = {'rows': rows, 'mismatches': mismatches}
+        self.source.logger.info('%s: %s', source.name, Stats.estimate(rows, mismatches))
+        if self.escalate is not None and rows and 100.0 * mismatches / rows > self.escalate:
+            self.source.logger.info('Comparing all rows of %s', source.name)
+            self.compare_rows(source, target, fields_in_source, fields_in_target,
+                              ' AND '.join(filter(None, [source.key_range(lower, upper), where])))
+
+    def compare_checksum(self, source, target, fields, lower=None, upper=None, where=None):
+        for lower, upper in self.chunks(source, lower, upper, where):
+            self.compare_range(source, target, fields, lower, upper, where)
+
+    def run(self):
+        while not self.queue.empty():
+            try:
+                (source, target, part) = self.queue.get(False)
+            except Queue.Empty:
+                break
+            try:
+                result = self.work(source, target, part)
+            except Exception:
+                self.source.logger.exception('Failed to compare table %s', (source or target).name)
+                self.failed.append((source or target).name)
+                # whatever the failed query left unread must not get in the way of the next unit
+                self.source.reconnect()
+                self.target.reconnect()
+                continue
+            if result is not None:
+                self.output.put(result)
+        self.source.release()
+        self.target.release()
+        return None
+
+    def work(self, source, target, part=None):
+        return retried(lambda: self.compare(source, target, part), (source or target).name,
+                       [self.source, self.target], lambda: self.streamed)
 
-                    cursor = self.source.connection.cursor(SSCursor)
-                    cursor.execute('SELECT `%s` FROM `%s`' % ('`,`'.join(fields_in_source), source.name))
-                    for row in cursor.fetchall():
-                        row = Row(row, source, fields_in_source)
-                        rows_in_source[row.key] = row
-
-                    cursor = self.target.connection.cursor(SSCursor)
-                    cursor.execute('SELECT `%s` FROM `%s`' % ('`,`'.join(fields_in_target), target.name))
-
-                    for row in cursor.fetchall():
-                        row = Row(row, target, fields_in_target)
-                        if row.key in rows_in_source:
-                            if row != rows_in_source[row.key]:
-                                query = ['UPDATE `%s`' % target.name, 'SET']
-
-                                (buf, condition) = [], []
-                                for k, v in enumerate(rows_in_source[row.key].seq):
-                                    field = fields_in_source[k]
-                                    if str(v) != str(row[field]):
-                                        buf.append("`%s`=%s" % (field, Row.escape(v)))
-                                query.append(', '.join(buf))
-
-                                query.append('WHERE')
-                                for field in source.pk_fields:
-                                    condition.append("`%s`=%s" % (field, Row.escape(row[field])))
-                                query.append(' AND '.join(condition))
-                                self.update.append(' '.join(query))
-                            del rows_in_source[row.key]
-                        else:
-                            query = ['DELETE FROM `%s`' % target.name, 'WHERE']
-                            condition = []
-                            for field in source.pk_fields:
-                                condition.append("`%s`=%s" % (field, Row.escape(row[field])))
-                            query.append(' AND '.join(condition))
-                            self.delete.append(' '.join(query))
-                    for key, row in rows_in_source.items():
-                        self.insert.append(
-                            'INSERT INTO `%s` (`%s`) VALUES %s' % (target.name, '`,`'.join(fields_in_source), str(row)))
-        if self.drop or self.create or self.alter or self.truncate or self.update or self.delete or self.insert:
-            self.lock.acquire()
-            self.buf.write('/* SYNC TABLE : `%s` */\n' % (source.name if source is not None else target.name))
-            if self.create:
-                self.buf.write('%s;\n' % ';\n'.join(self.create))
-            if self.drop:
-                self.buf.write('%s;\n' % ';\n'.join(self.drop))
-            if self.truncate:
-                self.buf.write('%s;\n' % ';\n'.join(self.truncate))
-            if self.alter:
-                self.buf.write('ALTER TABLE `%s` %s;\n' % (source.name, ', '.join(self.alter)))
-            if self.delete:
-                self.buf.write('%s;\n' % ';\n'.join(self.delete))
-            if self.update:
-                self.buf.write('%s;\n' % ';\n'.join(self.update))
-            if self.insert:
-                self.buf.write('%s;\n' % ';\n'.join(self.insert))
-            self.buf.write('\n')
-            self.lock.release()
-        return
+
+class Fanout(threading.Thread):
+    def __init__(self, lanes, queue, outputs):
+        """
+        Compare each (source, targets, part) unit of queue against several targets at once, reading what the whole
+        source table is read for only once for all of them, and put the result of each target on its own output.
+        @param lanes   list  Dbffer comparing the source with each target, on a target connection of their own and
+                             the one source connection they share, as they take turns reading it
+        @param outputs list  Queue.Queue of each target, in the order of lanes
+        """
+        self.lanes = lanes
+        self.queue = queue
+        self.outputs = outputs
+        # names of the tables failing to compare
+        self.failed = []
+        threading.Thread.__init__(self)
 
     def run(self):
         while not self.queue.empty():
             try:
-                (source, target) = self.queue.get(False)
-                self.compare(source, target)
+                (source, targets, part) = self.queue.get(False)
             except Queue.Empty:
                 break
+            try:
+                results = self.work(source, targets, part)
+            except Exception:
+                self.lanes[0].source.logger.exception('Failed to compare table %s', unit_name(source, targets))
+                self.failed.append(unit_name(source, targets))
+                for db in self.databases:
+                    db.reconnect()
+                continue
+            for output, result in zip(self.outputs, results):
+                if result is not None:
+                    output.put(result)
+        for db in self.databases:
+            db.release()
         return None
 
+    @property
+    def databases(self):
+        """
+        @return list  the source the lanes share, then the target of each lane
+        """
+        return [self.lanes[0].source] + [lane.target for lane in self.lanes]
+
+    def work(self, source, targets, part=None):
+        return retried(lambda: self.compare(source, targets, part), unit_name(source, targets), self.databases,
+                       lambda: [lane for lane in self.lanes if lane.streamed])
+
+    def compare(self, source, targets, part=None):
+        """
+        @param targets list  the table in each target, None where a target does not have it
+        @return list  what Dbffer.compare returns for each target
+        """
+        if len(self.lanes) == 1:
+            return [self.lanes[0].compare(source, targets[0], part)]
+        (compared, shared) = ([], {})
+        for lane, target in zip(self.lanes, targets):
+            begin = time.time()
+            lane.shared = []
+            try:
+                compared.append((source is not None or target is not None) and lane.diff(source, target, part))
+            finally:
+                (work, lane.shared) = (lane.shared, None)
+            lane.measure('diff', time.time() - begin)
+            for item in work:
+                shared.setdefault(self.key(lane, item), []).append((lane,) + item)
+        for key, items in shared.items():
+            begin = time.time()
+            if key == 'dump':
+                self.dump(items)
+            else:
+                self.merge(items)
+            for item in items:
+                item[0].measure('diff', time.time() - begin)
+        return [lane.result(source if source is not None else target, part) if done else None
+                for lane, target, done in zip(self.lanes, targets, compared)]
+
+    @staticmethod
+    def key(lane, work):
+        """
+        @return  what tells apart the work left by lanes that read different rows of the source table
+        """
+        if work[0] == 'dump':
+            return 'dump'
+        (kind, source, target, fields_in_source, fields_in_target, condition) = work
+        digests = lane.digested(source, fields_in_source, fields_in_target)
+        return kind, source.pk_fields, tuple(fields_in_source), condition, Dbffer.select(fields_in_source, digests)
+
+    @staticmethod
+    def dump(items):
+        """
+        Dump the source table once and hand its INSERT statements to every lane missing it.
+        """
+        (lead, kind, table) = items[0]
+        (statements, batchers) = (len(lead.insert), len(lead.batchers))
+        lead.dump(table)
+        for (lane, kind, table) in items[1:]:
+            lane.insert.extend(lead.insert[statements:])
+            lane.batchers.extend(lead.batchers[batchers:])
+
+    def merge(self, items):
+        """
+        Read the source rows once, like Dbffer.compare_rows or Dbffer.compare_spill, and merge join them with the rows
+        of each target in a thread per lane.
+        """
+        (lead, kind, source, target, fields_in_source, fields_in_target, condition) = items[0]
+        if len(items) == 1:
+            compare = lead.compare_spill if kind == 'spill' else lead.compare_rows
+            return compare(source, target, fields_in_source, fields_in_target, condition)
+        columns = Dbffer.select(fields_in_source, lead.digested(source, fields_in_source, fields_in_target))
+        if kind == 'spill':
+            rows = lead.spill(lead.source, source, fields_in_source, condition, columns)
+            batches = iter(lambda: list(itertools.islice(rows, Dbffer.BATCH_SIZE)), [])
+        else:
+            layout = source.layout(fields_in_source)
+            batches = ([Row(row, layout) for row in rows] for rows in
+                       lead.prefetch(lead.source, Dbffer.query(source, fields_in_source, condition, columns)))
+        (threads, errors) = ([], [])
+        for stream, item in zip(lead.tee(batches, len(items)), items):
+            thread = threading.Thread(target=self.follow, args=(stream, errors) + item)
+            thread.start()
+            threads.append(thread)
+        for thread in threads:
+            thread.join()
+        if errors:
+            raise errors[0][0], errors[0][1], errors[0][2]
+
+    @staticmethod
+    def follow(stream, errors, lane, kind, source, target, fields_in_source, fields_in_target, condition):
+        """
+        Merge join the shared source rows of stream with the rows of the target of lane.
+        """
+        try:
+            digests = lane.digested(source, fields_in_source, fields_in_target)
+            read = lane.spill if kind == 'spill' else lane.rows
+            lane.merge(source, target, fields_in_source, fields_in_target, (row for rows in stream for row in rows),
+                       read(lane.target, target, fields_in_target, condition, Dbffer.select(fields_in_target, digests)),
+                       Dbffer.deferred(source, fields_in_source, digests))
+        except Exception:
+            errors.append(sys.exc_info())
+            # keep taking the batches, or the lanes still merging would never get theirs
+            for rows in stream:
+                pass
+
+
+class Batcher(object):
+    def __init__(self, statements, prefix, suffix='', size=16777216, flushed=None):
+        """
+        Join values added one by one into as few prefix + values + suffix statements as fit in size bytes,
+        appending each finished statement to statements.
+        @param statements list
+        @param prefix     str
+        @param suffix     str
+        @param size       int       usually the max_allowed_packet of the server the statements are meant for
+        @param flushed    function  called once a statement is appended
+        """
+        self.statements = statements
+        self.prefix = prefix
+        self.suffix = suffix
+        self.size = size
+        self.flushed = flushed
+        self.values = []
+        self.length = len(prefix) + len(suffix)
+        # values added so far
+        self.count = 0
+
+    def add(self, value):
+        if self.values and self.length + len(value) + 1 >= self.size:
+            self.flush()
+        self.count += 1
+        self.values.append(value)
+        self.length += len(value) + 1
+
+    def flush(self):
+        if self.values:
+            self.statements.append('%s%s%s' % (self.prefix, ','.join(self.values), self.suffix))
+        self.values = []
+        self.length = len(self.prefix) + len(self.suffix)
+        if self.flushed is not None:
+            self.flushed()
+
+
+class Layout(object):
+    def __init__(self, fields, pk_fields, encoders=None):
+        """
+        Where each field and the primary key sit in the rows of one select list, shared by all those rows.
+        @param fields    list
+        @param pk_fields tuple
+        @param encoders  list   Column.encoder of each field, Row.escape when not given
+        """
+        self.fields = tuple(fields)
+        self.encoders = tuple(encoders or [Row.escape] * len(fields))
+        self.positions = dict([(field, i) for i, field in enumerate(fields)])
+        positions = tuple([self.positions.get(field) for field in pk_fields])
+        if None in positions:
+            self.key = lambda seq: tuple([seq[i] if i is not None else None for i in positions])
+        elif len(positions) == 1:
+            i = positions[0]
+            self.key = lambda seq: (seq[i],)
+        elif positions:
+            self.key = operator.itemgetter(*positions)
+        else:
+            self.key = lambda seq: ()
+
+    def literal(self, seq):
+        return '(%s)' % ','.join([encode(value) for encode, value in zip(self.encoders, seq)])
+
 
 class Row(object):
-    def __init__(self, seq, table, fields):
-        self.fields = fields
+    __slots__ = ('seq', 'key', 'layout')
+
+    def __init__(self, seq, layout):
         self.seq = seq
-        self.key = tuple([self[field] for field in table.pk_fields])
+        self.layout = layout
+        self.key = layout.key(seq)
 
     @staticmethod
     def escape(o):
@@ -366,15 +2352,25 @@ class Row(object):
         return ("'%s'" % MySQLdb.escape_string(str(o))).replace("\n", "\\n")
 
     def __str__(self):
-        return '(%s)' % ','.join(map(Row.escape, self.seq))
+        return self.layout.literal(self.seq)
+
+    @staticmethod
+    def same(a, b):
+        """
+        Values are compared as the types the driver returned, only falling back to their text when the types differ,
+        e.g. a column whose type changed between source and target.
+        """
+        return a == b or type(a) is not type(b) and a is not None and b is not None and str(a) == str(b)
 
     def __eq__(self, other):
         if type(other) != Row or self.key != other.key:
             return False
+        if self.seq == other.seq:
+            return True
         if len(self.seq) != len(other.seq):
             return False
         for pair in zip(self.seq, other.seq):
-            if str(pair[0]) != str(pair[1]):
+            if not Row.same(pair[0], pair[1]):
                 return False
         return True
 
@@ -382,10 +2378,15 @@ class Row(object):
         return not self == other
 
     def __getitem__(self, item):
-        return self.seq[self.fields.index(item)] if item in self.fields else None
+        i = self.layout.positions.get(item)
+        return self.seq[i] if i is not None else None
 
 
 class Column(object):
+    NUMBERS = ('tinyint', 'smallint', 'mediumint', 'int', 'integer', 'bigint', 'decimal', 'numeric', 'year')
+    FLOATS = ('float', 'double', 'real')
+    BINARIES = ('binary', 'varbinary', 'tinyblob', 'blob', 'mediumblob', 'longblob', 'bit')
+
     def __init__(self, definition):
         """
         @param self
@@ -415,6 +2416,56 @@ class Column(object):
     def __ne__(self, other):
         return not self == other
 
+    @property
+    def encoder(self):
+        """
+        Turn a value of this column into an SQL literal, picked once by the column type instead of once per value.
+        """
+        kind = re.match(r'\w*', self.type).group(0).lower()
+        if kind in Column.NUMBERS:
+            return Column.number
+        if kind in Column.FLOATS:
+            return Column.real
+        if kind in Column.BINARIES:
+            return Column.binary
+        return Column.text
+
+    @staticmethod
+    def number(o):
+        return 'NULL' if o is None else str(o)
+
+    @staticmethod
+    def real(o):
+        # repr of a float reads back to the same float, str rounds it to 12 digits
+        if o is None:
+            return 'NULL'
+        return repr(o) if type(o) is float else str(o)
+
+    @staticmethod
+    def binary(o):
+        if o is None:
+            return 'NULL'
+        return '0x%s' % binascii.hexlify(o) if o else "''"
+
+    @staticmethod
+    def text(o):
+        if o is None:
+            return 'NULL'
+        return "'%s'" % MySQLdb.escape_string(o if type(o) is str else str(o))
+
+    @staticmethod
+    def unquote(default):
+        """
+        Turn a COLUMN_DEFAULT of MariaDB 10.2.7 and later, which quotes literals and reports DEFAULT NULL as the
+        string NULL, into the default SHOW FULL COLUMNS reports.
+        """
+        if default is None or default == 'NULL':
+            return None
+        if len(default) > 1 and default[0] == default[-1] == "'":
+            return re.sub(r"''|\\(.)", lambda m: {'0': '\0', 'n': '\n', 'r': '\r', 'Z': '\x1a'}.get(
+                m.group(1), m.group(1) or "'"), default[1:-1])
+        return default
+
     def __str__(self):
         definition = [self.type]
         if self.null == 'NO':
@@ -476,18 +2527,24 @@ class Index(object):
 
 
 class Table(object):
-    def __init__(self, name, db):
+    def __init__(self, name, db, status=None, columns=None, indexes=None):
         """
-        @param name str
-        @param db   Database
+        @param name    str
+        @param db      Database or Snapshot
+        @param status  tuple  row of SHOW TABLE STATUS, queried from db when not given
+        @param columns list   rows of SHOW FULL COLUMNS, queried from db when not given
+        @param indexes list   rows of SHOW INDEX, queried from db when not given
         """
         self.db = db
         self.pk_fields = ()
         self.columns = []
         self.indexes = {}
+        self.layouts = {}
 
-        cursor = db.connection.cursor(SSCursor)
-        cursor.execute("show table status like '%s'" % name)
+        cursor = db.connection.cursor(SSCursor) if None in (status, columns, indexes) else None
+        if status is None:
+            cursor.execute("show table status like '%s'" % name)
+            status = cursor.fetchall()[0]
         (
             self.name,
             self.engine,
@@ -507,20 +2564,119 @@ class Table(object):
             self.checksum,
             self.create_options,
             self.comment
-        ) = cursor.fetchall()[0]
+        ) = status
 
-        cursor.execute('show full columns from `%s`' % self.name)
-        for row in cursor.fetchall():
+        if columns is None:
+            cursor.execute('show full columns from `%s`' % self.name)
+            columns = cursor.fetchall()
+        for row in columns:
             column = Column(row)
             self.columns.append(column)
-        cursor.execute('show index from `%s`' % self.name)
-        for index in [Index(row) for row in cursor.fetchall()]:
+        if indexes is None:
+            cursor.execute('show index from `%s`' % self.name)
+            indexes = cursor.fetchall()
+        for index in [Index(row) for row in indexes]:
             if index.key_name not in self.indexes:
                 self.indexes[index.key_name] = []
             self.indexes[index.key_name].append(index)
         if 'PRIMARY' in self.indexes:
             self.pk_fields = tuple([index.column_name for index in self.indexes['PRIMARY']])
-        cursor.close()
+        # what the table was built from, for a Snapshot to build it again
+        self.definition = (status, columns, indexes)
+        if cursor is not None:
+            cursor.close()
+
+    def unique_keys(self):
+        """
+        @return list  columns of each UNIQUE index but PRIMARY without any nullable column, those of fewer columns
+                      first, as good a key as a primary key for telling rows apart
+        """
+        nullable = set([column.field for column in self.columns if column.null != 'NO'])
+        keys = []
+        for name, index in self.indexes.items():
+            fields = tuple([item.column_name for item in sorted(index, key=lambda item: int(item.seq_in_index))])
+            if name != 'PRIMARY' and not int(index[0].non_unique) and not nullable & set(fields):
+                keys.append((len(fields), name, fields))
+        return [fields for (length, name, fields) in sorted(keys)]
+
+    def keyed(self, fields):
+        """
+        @return Table  a copy of this table taking fields for its primary key
+        """
+        table = copy.copy(self)
+        table.pk_fields = tuple(fields)
+        table.layouts = {}
+        return table
+
+    def __getstate__(self):
+        # layouts hold lambdas, and are built again as needed
+        state = self.__dict__.copy()
+        state['layouts'] = {}
+        return state
+
+    def key_range(self, lower=None, upper=None):
+        """
+        @param lower tuple  exclusive lower bound of the primary key, None for unbounded
+        @param upper tuple  inclusive upper bound of the primary key, None for unbounded
+        """
+        columns = '(`%s`)' % '`,`'.join(self.pk_fields)
+        condition = []
+        if lower is not None:
+            condition.append('%s > %s' % (columns, self.layout(self.pk_fields).literal(lower)))
+        if upper is not None:
+            condition.append('%s <= %s' % (columns, self.layout(self.pk_fields).literal(upper)))
+        return ' AND '.join(condition)
+
+    @property
+    def key_order(self):
+        """
+        Primary key ORDER BY clause, comparing strings by their bytes so rows come back in the order
+        Python compares the keys in.
+        """
+        columns = dict([(column.field, column) for column in self.columns])
+        order = []
+        for field in self.pk_fields:
+            if field in columns and columns[field].collation is not None:
+                order.append('BINARY `%s`' % field)
+            else:
+                order.append('`%s`' % field)
+        return ', '.join(order)
+
+    def layout(self, fields):
+        if tuple(fields) not in self.layouts:
+            encoders = dict([(column.field, column.encoder) for column in self.columns])
+            self.layouts[tuple(fields)] = Layout(fields, self.pk_fields,
+                                                 [encoders.get(field, Row.escape) for field in fields])
+        return self.layouts[tuple(fields)]
+
+    @property
+    def key_columns(self):
+        if len(self.pk_fields) == 1:
+            return '`%s`' % self.pk_fields[0]
+        return '(`%s`)' % '`,`'.join(self.pk_fields)
+
+    def key_literal(self, key):
+        literal = self.layout(self.pk_fields).literal(key)
+        return literal if len(self.pk_fields) != 1 else literal[1:-1]
+
+    def key_in(self, keys):
+        return '%s IN (%s)' % (self.key_columns, ','.join([self.key_literal(key) for key in keys]))
+
+    @staticmethod
+    def row_expression(fields):
+        """
+        A string telling rows apart on the server, NULL included.
+        """
+        return "CONCAT_WS('#', `%s`, CONCAT(%s))" % (
+            '`, `'.join(fields), ', '.join(['ISNULL(`%s`)' % field for field in fields]))
+
+    @staticmethod
+    def checksum_expression(fields):
+        return 'COALESCE(BIT_XOR(CAST(CRC32(%s) AS UNSIGNED)), 0)' % Table.row_expression(fields)
+
+    @staticmethod
+    def digest_expression(fields):
+        return 'UNHEX(MD5(%s))' % Table.row_expression(fields)
 
     def __eq__(self, other):
         if self.name != other.name or self.engine != other.engine or self.comment != other.comment or \
@@ -545,10 +2701,95 @@ class Table(object):
         return False
 
 
+class ConnectionPool(object):
+    # MySQL client errors after which a connection is useless: server has gone away, lost connection during query
+    GONE_AWAY = (2006, 2013)
+
+    def __init__(self, server, logger, max_connections=None, shared=None):
+        """
+        Connections to one schema of a server, shared by the workers comparing it.
+        @param server
+        @param max_connections int             block acquire once this many connections are out, None for no limit
+        @param shared          ConnectionPool  of another schema of the same server, whose connections count against
+                                               max_connections along with these
+        """
+        self.server = server
+        self.logger = logger
+        self.max_connections = max_connections
+        self.shared = shared
+        self.reset()
+
+    def reset(self):
+        """
+        Forget all connections, e.g. the ones a forked worker process inherited from its parent.
+        """
+        self.idle = []
+        self.lock = threading.Lock()
+        self.limit = threading.BoundedSemaphore(self.max_connections) \
+            if self.max_connections and self.shared is None else None
+
+    @property
+    def semaphore(self):
+        return self.shared.semaphore if self.shared is not None else self.limit
+
+    def __getstate__(self):
+        # neither connections nor locks pickle, a pool comes out of pickling as reset
+        state = self.__dict__.copy()
+        (state['idle'], state['lock'], state['limit']) = ([], None, None)
+        state['logger'] = self.logger.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger(state['logger'])
+        self.reset()
+
+    def connect(self):
+        self.logger.debug('Connecting to server %s...', self.server[0])
+        connection = MySQLdb.connect(*self.server)
+        self.logger.debug('Set connection charset utf8...')
+        cursor = connection.cursor()
+        cursor.execute('SET NAMES utf8')
+        cursor.close()
+        return connection
+
+    def acquire(self):
+        if self.semaphore is not None:
+            self.semaphore.acquire()
+        with self.lock:
+            connection = self.idle.pop() if self.idle else None
+        if connection is not None:
+            try:
+                connection.ping()
+            except MySQLdb.OperationalError:
+                self.logger.debug('Dropping dead connection to server %s', self.server[0])
+                connection = None
+        if connection is None:
+            connection = self.connect()
+        return connection
+
+    def release(self, connection):
+        with self.lock:
+            self.idle.append(connection)
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+    def discard(self, connection):
+        try:
+            connection.close()
+        except MySQLdb.Error:
+            pass
+        if self.semaphore is not None:
+            self.semaphore.release()
+
+
 class Database(object):
-    def __init__(self, server, logger, tables=None):
+    def __init__(self, server, logger, tables=None, whitelist=None, blacklist=None, pool=None):
         """
         @param server
+        @param whitelist list            only load these tables
+        @param blacklist list            do not load these tables
+        @param pool      ConnectionPool  where to take the connection from, a new unlimited one when not given
         """
         (
             self.host,
@@ -558,26 +2799,64 @@ class Database(object):
             self.port
         ) = server
         self.logger = logger
-        self.logger.debug('Connecting to server %s...', self.host)
-        self.connection = MySQLdb.connect(*server)
+        self.pool = pool or ConnectionPool(server, logger)
+        self.connection = self.pool.acquire()
         self.tables = {}
         self.server_version = None
 
-        self.logger.debug('Set connection charset utf8...')
-        cursor = self.connection.cursor(DictCursor)
-        cursor.execute('SET NAMES utf8')
-
         if tables is None:
             self.logger.debug('List tables from %s...', self.name)
-            cursor.execute('SHOW TABLE STATUS FROM `%s` WHERE ENGINE IS NOT NULL' % self.name)
-            for row in cursor.fetchall():
-                table = Table(row['Name'], self)
-                self.logger.debug('Found table %s', table.name)
-                self.tables[table.name] = table
+            self.load(whitelist, blacklist)
         else:
             self.tables = tables
+
+    def load(self, whitelist=None, blacklist=None):
+        """
+        Read tables, columns and indexes of the whole schema from information_schema in three queries,
+        instead of three SHOW statements per table.
+        """
+        condition = ["TABLE_SCHEMA = '%s'" % MySQLdb.escape_string(self.name)]
+        if whitelist:
+            condition.append('TABLE_NAME IN (%s)' % ','.join(
+                ["'%s'" % MySQLdb.escape_string(name) for name in whitelist]))
+        if blacklist:
+            condition.append('TABLE_NAME NOT IN (%s)' % ','.join(
+                ["'%s'" % MySQLdb.escape_string(name) for name in blacklist]))
+        condition = ' AND '.join(condition)
+
+        cursor = self.connection.cursor()
+        cursor.execute('SELECT TABLE_NAME, ENGINE, VERSION, ROW_FORMAT, TABLE_ROWS, AVG_ROW_LENGTH, DATA_LENGTH, '
+                       'MAX_DATA_LENGTH, INDEX_LENGTH, DATA_FREE, AUTO_INCREMENT, CREATE_TIME, UPDATE_TIME, '
+                       'CHECK_TIME, TABLE_COLLATION, CHECKSUM, CREATE_OPTIONS, TABLE_COMMENT '
+                       'FROM information_schema.TABLES WHERE %s AND ENGINE IS NOT NULL' % condition)
+        status = dict([(row[0], row) for row in cursor.fetchall()])
+        columns = dict([(name, []) for name in status])
+        indexes = dict([(name, []) for name in status])
+
+        cursor.execute('SELECT TABLE_NAME, COLUMN_NAME, COLUMN_TYPE, COLLATION_NAME, IS_NULLABLE, COLUMN_KEY, '
+                       'COLUMN_DEFAULT, EXTRA, PRIVILEGES, COLUMN_COMMENT '
+                       'FROM information_schema.COLUMNS WHERE %s ORDER BY TABLE_NAME, ORDINAL_POSITION' % condition)
+        quoted = self.quotes_defaults
+        for row in cursor.fetchall():
+            if row[0] in columns:
+                if quoted:
+                    row = row[:6] + (Column.unquote(row[6]),) + row[7:]
+                columns[row[0]].append(row[1:])
+
+        cursor.execute('SELECT TABLE_NAME, NON_UNIQUE, INDEX_NAME, SEQ_IN_INDEX, COLUMN_NAME, COLLATION, CARDINALITY, '
+                       'SUB_PART, PACKED, NULLABLE, INDEX_TYPE, COMMENT, INDEX_COMMENT '
+                       'FROM information_schema.STATISTICS WHERE %s '
+                       'ORDER BY TABLE_NAME, INDEX_NAME, SEQ_IN_INDEX' % condition)
+        for row in cursor.fetchall():
+            if row[0] in indexes:
+                indexes[row[0]].append(row)
         cursor.close()
 
+        for name in status:
+            table = Table(name, self, status[name], columns[name], indexes[name])
+            self.logger.debug('Found table %s', table.name)
+            self.tables[table.name] = table
+
     def __contains__(self, item):
         for table in self.tables.values():
             if table == item:
@@ -592,10 +2871,265 @@ class Database(object):
             self.server_version = cursor.fetchone()['version']
         return self.server_version
 
+    @property
+    def quotes_defaults(self):
+        """
+        @return bool  whether information_schema.COLUMNS quotes literal defaults, as MariaDB does since 10.2.7
+        """
+        version = re.match(r'(\d+)\.(\d+)\.(\d+)', self.version)
+        return 'mariadb' in self.version.lower() and version is not None and \
+            tuple([int(part) for part in version.groups()]) >= (10, 2, 7)
+
+    @property
+    def max_allowed_packet(self):
+        cursor = self.connection.cursor(DictCursor)
+        cursor.execute('SELECT @@max_allowed_packet `max_allowed_packet`')
+        max_allowed_packet = int(cursor.fetchone()['max_allowed_packet'])
+        cursor.close()
+        return max_allowed_packet
+
+    def __getstate__(self):
+        # neither connections nor the locks of logging handlers pickle: workers of the process backend clone their
+        # connections from the pool, which pickles reset
+        state = self.__dict__.copy()
+        state['connection'] = None
+        state['logger'] = self.logger.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger(state['logger'])
+
+    def clone(self):
+        return Database((self.host, self.username, self.password, self.name, self.port), self.logger,
+                        copy.copy(self.tables), pool=self.pool)
+
+    def reconnect(self):
+        self.pool.discard(self.connection)
+        self.connection = self.pool.acquire()
+
+    def release(self):
+        self.pool.release(self.connection)
+        self.connection = None
+
+    def close(self):
+        self.pool.discard(self.connection)
+        self.connection = None
+        self.tables.clear()
+
+
+class Snapshot(object):
+    # rows per chunk of a table file, what the chunk index points at
+    CHUNK_ROWS = 10000
+
+    def __init__(self, path, logger, whitelist=None, blacklist=None):
+        """
+        A schema exported to a directory by Snapshot.export, compared in place of a Database on either side without
+        querying any server. The file of each table holds its rows sorted by primary key in pickled chunks, read
+        through mmap, and the schema file the tables, columns and indexes with the index of those chunks.
+        @param path str  the directory
+        """
+        self.path = path
+        self.logger = logger
+        self.connection = None
+        self.pool = None
+        with open(os.path.join(path, 'schema'), 'rb') as f:
+            self.schema = cPickle.load(f)
+        (self.host, self.port, self.name) = self.schema['server']
+        self.version = self.schema['version']
+        self.max_allowed_packet = self.schema['max_allowed_packet']
+        self.tables = {}
+        for name, item in self.schema['tables'].items():
+            if whitelist and name not in whitelist or blacklist and name in blacklist:
+                continue
+            self.tables[name] = Table(name, self, *item['definition'])
+        self.logger.debug('Loaded %d tables of %s from snapshot %s', len(self.tables), self.name, path)
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['logger'] = self.logger.name
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.logger = logging.getLogger(state['logger'])
+
+    @staticmethod
+    def export(db, path, logger, digests=False):
+        """
+        Write every table of db to path as of one moment, the schema file last, so a snapshot cut short is not
+        taken for a whole one.
+        @param digests bool  also keep the digest the server computes of each row in hash mode, so hash mode can
+                             compare the snapshot against a server without reading any more of it than that
+        """
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        schema = {
+            'server': (db.host, db.port, db.name),
+            'version': db.version,
+            'max_allowed_packet': db.max_allowed_packet,
+            'tables': {},
+        }
+        cursor = db.connection.cursor(SSCursor)
+        cursor.execute('SET SESSION TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        cursor.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+        for name, table in sorted(db.tables.items()):
+            begin = time.time()
+            cursor.execute('SHOW CREATE TABLE `%s`;' % name)
+            create = str(cursor.fetchall()[0][1])
+            fields = [column.field for column in table.columns]
+            key = table.layout(fields).key
+            columns = '`%s`' % '`,`'.join(fields)
+            if digests and table.pk_fields:
+                columns += ', %s' % Table.digest_expression(fields)
+            cursor.execute(Dbffer.query(table, fields, None, columns))
+            (chunks, count) = ([], 0)
+            with open(os.path.join(path, urllib.quote(name, '')), 'wb') as f:
+                while True:
+                    rows = cursor.fetchmany(Snapshot.CHUNK_ROWS)
+                    if not rows:
+                        break
+                    data = cPickle.dumps([tuple(row) for row in rows], cPickle.HIGHEST_PROTOCOL)
+                    chunks.append((f.tell(), len(data), len(rows), key(rows[0]), key(rows[-1])))
+                    f.write(data)
+                    count += len(rows)
+            schema['tables'][name] = {
+                'definition': table.definition,
+                'create': create,
+                'digests': bool(digests and table.pk_fields),
+                'chunks': chunks,
+            }
+            logger.info('Exported %d rows of %s in %0.4f seconds', count, name, time.time() - begin)
+        cursor.execute('COMMIT')
+        cursor.close()
+        State.write(os.path.join(path, 'schema'), schema)
+
+    def create(self, name):
+        return self.schema['tables'][name]['create']
+
+    def digested(self, table):
+        return self.schema['tables'][table.name]['digests']
+
+    def span(self, table):
+        """
+        @return tuple  (lowest, highest) primary key of table, None when it has no row
+        """
+        chunks = self.schema['tables'][table.name]['chunks']
+        if not chunks:
+            return None, None
+        return chunks[0][3], chunks[-1][4]
+
+    def batches(self, table, fields, lower=None, upper=None, keys=None):
+        """
+        Read the rows of table in primary key order, skipping the chunks that hold none of the rows wanted.
+        @param fields list   fields to read of each row, None for the digest kept of it
+        @param lower  tuple  exclusive lower bound of the primary key, as in Table.key_range
+        @param upper  tuple  inclusive upper bound of the primary key
+        @param keys   list   sorted primary keys of the only rows to read
+        @return generator  of row batches
+        """
+        names = [column.field for column in table.columns]
+        # the digest is kept after every column
+        positions = [names.index(field) if field is not None else len(names) for field in fields]
+        key = table.layout(names).key
+        chunks = self.schema['tables'][table.name]['chunks']
+        wanted = set(keys) if keys is not None else None
+        if not chunks:
+            return
+        with open(os.path.join(self.path, urllib.quote(table.name, '')), 'rb') as f:
+            data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            try:
+                for (offset, length, count, first, last) in chunks:
+                    if upper is not None and first > upper:
+                        break
+                    if lower is not None and last <= lower:
+                        continue
+                    if keys is not None:
+                        i = bisect.bisect_left(keys, first)
+                        if i == len(keys) or keys[i] > last:
+                            continue
+                    rows = []
+                    for row in cPickle.loads(data[offset:offset + length]):
+                        if lower is not None or upper is not None or wanted is not None:
+                            k = key(row)
+                            if lower is not None and k <= lower or upper is not None and k > upper or \
+                                    wanted is not None and k not in wanted:
+                                continue
+                        rows.append(tuple([row[i] for i in positions]))
+                    if rows:
+                        yield rows
+            finally:
+                data.close()
+
     def clone(self):
-        return Database((self.host, self.username, self.password, self.name, self.port), self.logger, copy.copy(self.tables))
+        snapshot = copy.copy(self)
+        snapshot.tables = copy.copy(self.tables)
+        return snapshot
+
+    def reconnect(self):
+        pass
+
+    def release(self):
+        pass
 
     def close(self):
-        self.connection.close()
         self.tables.clear()
 
+
+def unit_name(source, targets):
+    """
+    @return str  name of the table a (source, targets, part) unit compares
+    """
+    return source.name if source is not None else [target for target in targets if target is not None][0].name
+
+
+def retried(compare, name, databases, streamed):
+    """
+    Call compare, once more on fresh connections if a server went away in the middle of it.
+    @param name      str       table compare compares
+    @param databases list      Database or Snapshot of each connection compare uses
+    @param streamed  function  telling whether compare already handed statements to the writer, which a second
+                               try would hand again
+    """
+    try:
+        return compare()
+    except MySQLdb.OperationalError, err:
+        if err.args[0] not in ConnectionPool.GONE_AWAY or streamed():
+            raise
+        databases[0].logger.warn('Lost connection comparing %s, retrying: %s', name, err)
+        for db in databases:
+            db.reconnect()
+        return compare()
+
+
+def process_init(source, targets, options):
+    """
+    Give each worker of the process backend a Fanout with its own connections, holding a Dbffer per target.
+    @param options list  keyword arguments of the Dbffer of each target
+    """
+    for db in [source] + targets:
+        if db.pool is not None:
+            db.pool.reset()
+    shared = source.clone()
+    process_compare.fanout = Fanout([Dbffer(shared, target.clone(), None, None, **lane)
+                                     for target, lane in zip(targets, options)], None, None)
+
+
+def process_compare(unit):
+    """
+    Compare one (source table name, target table names, part) unit in a worker process.
+    @return tuple  (table name, what Dbffer.compare returned for each target, None when it failed)
+    """
+    fanout = process_compare.fanout
+    (source, targets, part) = unit
+    lanes = fanout.lanes
+    name = source or [target for target in targets if target][0]
+    try:
+        return name, fanout.work(lanes[0].source.tables.get(source),
+                                 [lane.target.tables.get(target) for lane, target in zip(lanes, targets)], part)
+    except Exception:
+        lanes[0].source.logger.exception('Failed to compare table %s', name)
+        # as in Fanout.run, what the failed query left unread must not get in the way of the next unit
+        for db in fanout.databases:
+            db.reconnect()
+        return name, None